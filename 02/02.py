@@ -1,45 +1,340 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import itertools
+import math
+import multiprocessing
+import os
+import random
+import sys
 import unittest
 
-def read_input():
-    with open('input.txt') as f:
-        mem = list(map(int, f.read().split(',')))
-    return mem
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from intcode import BatchProgram, Feature, Memory, create_program, read_input
 
-def print_mem(mem):
-    print(','.join(map(str, mem)))
-        
 def run_program(mem):
+    create_program(mem, features=Feature.basic).run()
+
+# Returns what the program leaves in mem[0] for a noun and verb, running it
+# on a fork of image
+def get_output(image, noun, verb):
+    mem = image.fork()
+    mem[1] = noun
+    mem[2] = verb
+    run_program(mem)
+    return mem[0]
+
+# Tries every (noun, verb) pair, returning 100 * noun + verb for the first
+# that leaves target in mem[0], or None
+def find_noun_verb(mem, target, nouns=range(0, 100), verbs=range(0, 100)):
+    image = Memory(mem)
+    for noun in nouns:
+        for verb in verbs:
+            if get_output(image, noun, verb) == target:
+                return 100 * noun + verb
+    return None
+
+# Returns the index of the first value in seq for which pred is true, or
+# len(seq) if there isn't one. pred must be false then true along seq.
+def bisect_first(seq, pred):
+    (lo, hi) = (0, len(seq))
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if pred(seq[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+# Returns the direction of c * value along values, a range: 1 if it never
+# decreases, -1 if it never increases
+def linear_direction(c, values):
+    if c == 0 or len(values) < 2:
+        return 1
+    return 1 if (c > 0) == (values[-1] > values[0]) else -1
+
+# Set in each search worker by init_search_worker
+search_image = None
+# Index of the first chunk known to have a hit
+search_found = None
+
+def init_search_worker(mem, found):
+    global search_image, search_found
+    search_image = Memory(mem)
+    search_found = found
+
+# Searches the rows of one chunk of nouns, returning the first (noun, verb)
+# that gives target, or None. If verb_direction isn't 0 the output is
+# monotonic along each row, so rows are bisected. Gives up once an earlier
+# chunk has found a hit.
+def search_chunk(index, nouns, verbs, target, verb_direction):
+    for noun in nouns:
+        if search_found.value < index:
+            return None
+        if verb_direction:
+            sign = verb_direction
+            i = bisect_first(verbs, lambda verb: sign * get_output(search_image, noun, verb) >= sign * target)
+            hit = i < len(verbs) and get_output(search_image, noun, verbs[i]) == target
+            verb = verbs[i] if hit else None
+        else:
+            verb = next((verb for verb in verbs if get_output(search_image, noun, verb) == target), None)
+            hit = verb is not None
+        if hit:
+            with search_found.get_lock():
+                search_found.value = min(search_found.value, index)
+            return (noun, verb)
+    return None
+
+# Searches nouns x verbs for the first (noun, verb) that leaves target in
+# mem[0], returning it or None. Ranges can be of any size.
+#
+# With prune, the program is run symbolically (see run_symbolic) to find
+# what it leaves in mem[0]. If that is linear in the noun and verb, the
+# output is monotonic along each row, so rows are bisected rather than
+# scanned, and rows whose ends don't straddle target are skipped by
+# bisecting the nouns. Otherwise every row is scanned.
+#
+# The remaining rows are split into chunks of rows_per_chunk and searched
+# on a pool of worker processes, each given the program once. The first
+# hit, in order, is returned as soon as every chunk before it is done, and
+# the chunks after it give up.
+def search_noun_verb(mem, target, nouns=range(0, 100), verbs=range(0, 100), workers=None, rows_per_chunk=4, prune=True):
+    if not nouns or not verbs:
+        return None
+    image = Memory(mem)
+    verb_direction = 0
+    if prune:
+        try:
+            expr = run_symbolic(mem)
+        except CannotSolve:
+            expr = None
+        if expr is not None and all(i + j <= 1 for i, j in expr.terms):
+            noun_direction = linear_direction(expr.terms.get((1, 0), 0), nouns)
+            verb_direction = linear_direction(expr.terms.get((0, 1), 0), verbs)
+        else:
+            noun_direction = 0
+
+        if noun_direction and verb_direction:
+            # The outputs of each row lie between those at its ends
+            def low(noun):
+                return min(get_output(image, noun, verbs[0]), get_output(image, noun, verbs[-1]))
+            def high(noun):
+                return max(get_output(image, noun, verbs[0]), get_output(image, noun, verbs[-1]))
+            if noun_direction > 0:
+                first = bisect_first(nouns, lambda noun: high(noun) >= target)
+                end = bisect_first(nouns, lambda noun: low(noun) > target)
+            else:
+                first = bisect_first(nouns, lambda noun: low(noun) <= target)
+                end = bisect_first(nouns, lambda noun: high(noun) < target)
+            nouns = nouns[first:max(first, end)]
+
+    chunks = [nouns[i:i+rows_per_chunk] for i in range(0, len(nouns), rows_per_chunk)]
+    found = multiprocessing.Value('q', len(chunks))
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(chunks) <= 1:
+        init_search_worker(list(mem), found)
+        for index, chunk in enumerate(chunks):
+            pair = search_chunk(index, chunk, verbs, target, verb_direction)
+            if pair is not None:
+                return pair
+        return None
+
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_search_worker, initargs=(list(mem), found)) as executor:
+        futures = [executor.submit(search_chunk, index, chunk, verbs, target, verb_direction) for index, chunk in enumerate(chunks)]
+        try:
+            for future in futures:
+                pair = future.result()
+                if pair is not None:
+                    return pair
+            return None
+        finally:
+            for future in futures:
+                future.cancel()
+
+# A polynomial in the noun and verb, held as a dict from the powers of the
+# noun and verb in each term to its coefficient
+class Polynomial:
+    def __init__(self, terms):
+        self.terms = {powers: coeff for powers, coeff in terms.items() if coeff}
+
+    @staticmethod
+    def lift(val):
+        return val if isinstance(val, Polynomial) else Polynomial({(0, 0): val})
+
+    def __add__(self, other):
+        terms = dict(self.terms)
+        for powers, coeff in Polynomial.lift(other).terms.items():
+            terms[powers] = terms.get(powers, 0) + coeff
+        return Polynomial(terms)
+
+    def __mul__(self, other):
+        terms = {}
+        for (i, j), a in self.terms.items():
+            for (k, l), b in Polynomial.lift(other).terms.items():
+                terms[(i+k, j+l)] = terms.get((i+k, j+l), 0) + a * b
+        return Polynomial(terms)
+
+    __radd__ = __add__
+    __rmul__ = __mul__
+
+    def __call__(self, noun, verb):
+        return sum(coeff * noun**i * verb**j for (i, j), coeff in self.terms.items())
+
+    def __repr__(self):
+        return ' + '.join(f'{coeff}*n^{i}*v^{j}' for (i, j), coeff in sorted(self.terms.items())) or '0'
+
+    # Highest power of the noun (var 0) or verb (var 1)
+    def degree(self, var):
+        return max((powers[var] for powers in self.terms), default=0)
+
+    # Returns the coefficients of verb^0 and verb^1, as functions of the noun
+    def verb_coefficients(self):
+        return [Polynomial({(i, 0): coeff for (i, j), coeff in self.terms.items() if j == power}) for power in (0, 1)]
+
+NOUN = Polynomial({(1, 0): 1})
+VERB = Polynomial({(0, 1): 1})
+
+class CannotSolve(Exception):
+    pass
+
+# Runs the program with the noun and verb as symbols, returning what it
+# leaves in mem[0] as a Polynomial. A value read from an address that
+# depends on them is unknown (None), which is fine as long as nothing uses
+# it. Raises CannotSolve if the program's control flow or an address it
+# writes to depends on the noun or verb, or it uses an unknown value.
+def run_symbolic(mem):
+    mem = Memory(mem)
+    mem[1] = NOUN
+    mem[2] = VERB
+
+    def address(loc):
+        addr = mem[loc]
+        if not isinstance(addr, int):
+            raise CannotSolve(f'Address at {loc} depends on the noun and verb')
+        return addr
+
+    def read(loc):
+        val = mem[loc]
+        return mem[val] if isinstance(val, int) else None
+
     pc = 0
     while True:
-        pc = run_instruction(mem, pc)
-        if pc is None:
+        opcode = mem[pc]
+        if opcode == 99:
             break
+        if opcode not in [1, 2]:
+            raise CannotSolve(f'Opcode at {pc} is {opcode}')
+        (a, b) = (read(pc+1), read(pc+2))
+        if a is None or b is None:
+            val = None
+        else:
+            val = a + b if opcode == 1 else a * b
+        mem[address(pc+3)] = val
+        pc += 4
 
-def opcode_add(mem, pc):
-    mem[mem[pc+3]] = mem[mem[pc+1]] + mem[mem[pc+2]]
-    return pc+4
+    result = mem[0]
+    if result is None:
+        raise CannotSolve('mem[0] depends on an unknown value')
+    return Polynomial.lift(result)
 
-def opcode_multiply(mem, pc):
-    mem[mem[pc+3]] = mem[mem[pc+1]] * mem[mem[pc+2]]
-    return pc+4
+# Returns the first (noun, verb) for which c + p*noun + q*verb == target, or
+# None. Ranges must have a step of 1. Only nouns in one residue class give a
+# whole verb, and along that class the verb changes by a fixed amount, so the
+# first pair is found directly.
+def solve_linear(c, p, q, target, nouns, verbs):
+    if not nouns or not verbs:
+        return None
+    rhs = target - c
+    if q == 0:
+        if p == 0:
+            return (nouns.start, verbs.start) if rhs == 0 else None
+        if rhs % p == 0 and rhs // p in nouns:
+            return (rhs // p, verbs.start)
+        return None
+
+    # p * noun == rhs (mod |q|)
+    g = math.gcd(p, q)
+    if rhs % g:
+        return None
+    m = abs(q) // g
+    n0 = (rhs // g) * pow(p // g, -1, m) % m if m > 1 else 0
+    noun = nouns.start + (n0 - nouns.start) % m
+    verb = (rhs - p * noun) // q
+    # How much the verb drops for each step of m nouns
+    d = p * m // q
+    if d > 0:
+        k = max(0, (verb - verbs.stop) // d + 1)
+    elif d < 0:
+        k = max(0, -((verb - verbs.start) // -d))
+    else:
+        k = 0
+    (noun, verb) = (noun + k * m, verb - k * d)
+    if noun in nouns and verb in verbs:
+        return (noun, verb)
+    return None
 
-def opcode_exit(mem, pc):
+# Returns the first (noun, verb) for which expr gives target, or None
+def solve_polynomial(expr, target, nouns, verbs):
+    linear = all(i + j <= 1 for i, j in expr.terms)
+    if linear and nouns.step == 1 and verbs.step == 1:
+        terms = expr.terms
+        return solve_linear(terms.get((0, 0), 0), terms.get((1, 0), 0), terms.get((0, 1), 0), target, nouns, verbs)
+    if expr.degree(1) <= 1:
+        # Linear in the verb, so solve for it on each noun
+        (b, a) = expr.verb_coefficients()
+        for noun in nouns:
+            (coeff, rest) = (a(noun, 0), target - b(noun, 0))
+            if coeff == 0:
+                if rest == 0 and verbs:
+                    return (noun, verbs[0])
+            elif rest % coeff == 0 and rest // coeff in verbs:
+                return (noun, rest // coeff)
+        return None
+    for noun in nouns:
+        for verb in verbs:
+            if expr(noun, verb) == target:
+                return (noun, verb)
     return None
 
-# Returns PC of next instruction, or None if program should exit
-def run_instruction(mem, pc):
-    opcodes = {
-        1: opcode_add,
-        2: opcode_multiply,
-        99: opcode_exit,
-    }
+# Like find_noun_verb, but running the program once with the noun and verb as
+# symbols and solving for them, falling back to trying every pair if the
+# program can't be run symbolically
+def find_noun_verb_symbolic(mem, target, nouns=range(0, 100), verbs=range(0, 100)):
+    try:
+        expr = run_symbolic(mem)
+    except CannotSolve:
+        return find_noun_verb(mem, target, nouns, verbs)
+    pair = solve_polynomial(expr, target, nouns, verbs)
+    if pair is None:
+        return None
+    (noun, verb) = pair
+    return 100 * noun + verb
 
-    opcode = mem[pc]
-    if opcode not in opcodes:
-        raise Exception(f'Invalid opcode: {opcode}')
-    return opcodes[opcode](mem, pc)
+# Runs one copy of the program per row of mems, a 2D NumPy array, in
+# lockstep, returning the BatchProgram
+def run_program_batch(mems):
+    program = BatchProgram(mems)
+    program.run()
+    return program
+
+# Runs every (noun, verb) pair as one batch, returning 100 * noun + verb for
+# the first pair that halts leaving target in mem[0], or None. Pairs whose
+# run stops on an error are skipped.
+def find_noun_verb_batch(mem, target, nouns=range(0, 100), verbs=range(0, 100)):
+    pairs = np.array(list(itertools.product(nouns, verbs)), dtype=np.int64)
+    mems = np.tile(np.array(mem, dtype=np.int64), (len(pairs), 1))
+    mems[:, 1:3] = pairs
+    program = run_program_batch(mems)
+    found = np.flatnonzero(program.halted & (mems[:, 0] == target))
+    if len(found) == 0:
+        return None
+    (noun, verb) = pairs[found[0]]
+    return int(100 * noun + verb)
 
 class RunProgramTest(unittest.TestCase):
     def run_test(self, input, output):
@@ -52,16 +347,80 @@ class RunProgramTest(unittest.TestCase):
         self.run_test([2,4,4,5,99,0], [2,4,4,5,99,9801])
         self.run_test([1,1,1,4,99,5,6,0,99], [30,1,1,4,2,5,6,0,99])
 
+    def test_run_program_fork(self):
+        orig_mem = Memory([1,1,1,4,99,5,6,0,99])
+        mem = orig_mem.fork()
+        run_program(mem)
+        self.assertEqual(mem, [30,1,1,4,2,5,6,0,99])
+        self.assertEqual(orig_mem, [1,1,1,4,99,5,6,0,99])
+
+    def test_run_symbolic(self):
+        # mem[3] = mem[noun] + mem[verb], unknown but overwritten, then
+        # mem[0] = noun + verb
+        self.assertEqual(run_symbolic([1,0,0,3,1,1,2,0,99]).terms, {(1, 0): 1, (0, 1): 1})
+        # mem[0] = noun * verb + noun
+        self.assertEqual(run_symbolic([1,0,0,3,2,1,2,3,1,3,1,0,99]).terms, {(1, 1): 1, (1, 0): 1})
+        # mem[0] = mem[3] + mem[3], which isn't known
+        with self.assertRaises(CannotSolve):
+            run_symbolic([1,0,0,3,1,3,3,0,99])
+        # Writing to mem[noun + verb]
+        with self.assertRaises(CannotSolve):
+            run_symbolic([1,0,0,3,1,1,2,11,1,0,0,0,99])
+
+    def test_find_noun_verb_symbolic(self):
+        mem = read_input()
+        self.assertEqual(run_symbolic(mem).degree(0), 1)
+        self.assertEqual(find_noun_verb_symbolic(mem, 19690720), 6979)
+        self.assertEqual(find_noun_verb(mem, 19690720, range(69, 70)), 6979)
+        self.assertIsNone(find_noun_verb_symbolic(mem, 19690720, range(0, 50)))
+        # Falls back to the concrete search
+        self.assertEqual(find_noun_verb_symbolic([1,0,0,0,99], 2), 0)
+
+    def test_search_noun_verb(self):
+        for workers in [1, 2]:
+            for prune in [False, True]:
+                # mem[0] = noun * verb, with several hits
+                self.assertEqual(search_noun_verb([1,0,0,3,2,1,2,0,99], 12, range(1, 13), range(1, 13), workers, 1, prune), (1, 12))
+                self.assertIsNone(search_noun_verb([1,0,0,3,2,1,2,0,99], 13, range(2, 13), range(2, 13), workers, 1, prune))
+            # mem[0] = (noun - 5) * (verb - 5), which isn't monotonic
+            mem = [1,0,0,3, 1,1,17,1, 1,2,17,2, 2,1,2,0, 99, -5]
+            self.assertEqual(search_noun_verb(mem, 4, range(0, 11), range(0, 11), workers, 3), (1, 4))
+            # mem[0] = (verb - 3) ** 2, which turns between any 5 samples of
+            # the verbs
+            mem = [1,0,0,3, 1,2,13,2, 2,2,2,0, 99, -3]
+            self.assertEqual(search_noun_verb(mem, 4, range(0, 5), range(0, 100), workers), (0, 1))
+            self.assertEqual(find_noun_verb_symbolic(mem, 4, range(0, 5), range(0, 100)), 1)
+
+        mem = read_input()
+        self.assertEqual(search_noun_verb(mem, 19690720), (69, 79))
+        self.assertEqual(search_noun_verb(mem, 19690720, range(60, 80), range(0, 100), 2, prune=False), (69, 79))
+        # Far beyond 0..99, decreasing
+        self.assertEqual(search_noun_verb(mem, 613521 + 276480 * 123456 + 654321, range(10**6, 0, -1), range(10**6, 0, -1)), (123458, 101361))
+
+    def test_solve_polynomial(self):
+        rng = random.Random(2)
+        for _ in range(300):
+            terms = {(0, 0): rng.randint(-20, 20), (1, 0): rng.randint(-5, 5), (0, 1): rng.randint(-5, 5)}
+            if rng.random() < 0.3:
+                terms[(1, 1)] = rng.randint(-3, 3)
+            expr = Polynomial(terms)
+            nouns = range(rng.randint(-10, 10), rng.randint(-10, 20))
+            verbs = range(rng.randint(-10, 10), rng.randint(-10, 20))
+            target = expr(rng.randint(-10, 20), rng.randint(-10, 20))
+            expected = next(((n, v) for n in nouns for v in verbs if expr(n, v) == target), None)
+            self.assertEqual(solve_polynomial(expr, target, nouns, verbs), expected, (expr, target, nouns, verbs))
+
+    @unittest.skipIf(np is None, 'requires numpy')
+    def test_run_program_batch(self):
+        mems = np.array([[1,0,0,0,99], [2,3,0,3,99], [2,4,4,0,99]])
+        run_program_batch(mems)
+        self.assertEqual(mems.tolist(), [[2,0,0,0,99], [2,3,0,6,99], [9801,4,4,0,99]])
+
+        self.assertEqual(find_noun_verb_batch(read_input(), 19690720), 6979)
+        # A negative noun is an invalid address, not the last cell
+        self.assertIsNone(find_noun_verb_batch([1,0,0,0,99], 100, range(-1, 1), range(0, 1)))
+
 if __name__ == '__main__':
     unittest.main(exit=False)
 
-    orig_mem = read_input()
-    for noun in range(0, 100):
-        for verb in range(0, 100):
-            mem = orig_mem.copy()
-            mem[1] = noun
-            mem[2] = verb
-            run_program(mem)
-
-            if mem[0] == 19690720:
-                print(100 * noun + verb)
+    print(find_noun_verb_symbolic(read_input(), 19690720))
@@ -1,172 +1,299 @@
 #!/usr/bin/env python3
 
+import asyncio
+import concurrent.futures
 import itertools
+import os
+import sys
+import time
 import unittest
 
-def read_input():
-    with open('input.txt') as f:
-        mem = list(map(int, f.read().split(',')))
-    return mem
-
-def print_mem(mem):
-    print(','.join(map(str, mem)))
-
-class Program:
-    def __init__(self, mem, input_=None):
-        self.mem = mem
-        self.pc = 0
-        self.input = input_ if input_ else []
-        self.input_offset = 0
-        self.output = []
-
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from intcode import BatchProgram, Event, Feature, RunCache, create_program, read_input, warm_snapshot
+
+# Runs a network of programs as asyncio tasks. Each program reads from its
+# own bounded inbox, and every output is sent to the inbox of each program it
+# is connected to, so chains, rings and broadcasts are all built by connect.
+# A program waiting for input sleeps until another program sends it a value,
+# and one sending to a full inbox sleeps until there is room. Outputs are
+# taken off each program as they are sent, keeping only the last in
+# last_outputs.
+class Network:
+    # Instructions a program runs before letting the others run
+    time_slice = 1000
+
+    def __init__(self):
+        self.programs = {}
+        self.inboxes = {}
+        self.connections = {}
+        self.last_outputs = {}
+        self.waiting = set()
+        # The inbox each program blocked sending is waiting on
+        self.sending = {}
+        self.finished = set()
+        self.elapsed = None
+
+    def add(self, name, program, capacity=16):
+        self.programs[name] = program
+        self.inboxes[name] = asyncio.Queue(capacity)
+        self.connections[name] = []
+
+    # Sends every output of src to dst
+    def connect(self, src, dst):
+        self.connections[src].append(dst)
+
+    # Gives a program an input before the network runs
+    def send(self, name, value):
+        self.programs[name].input.append(value)
+
+    # Raises if every program that hasn't halted is blocked: waiting on an
+    # empty inbox, or sending to a full one
+    def check_deadlock(self):
+        if len(self.waiting) + len(self.sending) + len(self.finished) < len(self.programs):
+            return
+        if any(not self.inboxes[name].empty() for name in self.waiting):
+            return
+        if any(not self.inboxes[dst].full() for dst in self.sending.values()):
+            return
+        if self.waiting or self.sending:
+            raise Exception(f'Deadlock: {sorted(map(str, self.waiting))} waiting for input, '
+                            f'{sorted(map(str, self.sending))} waiting to send')
+
+    async def receive(self, name):
+        self.waiting.add(name)
+        try:
+            self.check_deadlock()
+            return await self.inboxes[name].get()
+        finally:
+            self.waiting.discard(name)
+
+    async def put(self, name, dst, value):
+        inbox = self.inboxes[dst]
+        if not inbox.full():
+            inbox.put_nowait(value)
+            return
+        self.sending[name] = dst
+        try:
+            self.check_deadlock()
+            await inbox.put(value)
+        finally:
+            del self.sending[name]
+
+    def finish(self, name):
+        self.finished.add(name)
+        # Drop anything left in the inbox, which also wakes any program
+        # blocked sending to it
+        inbox = self.inboxes[name]
+        while not inbox.empty():
+            inbox.get_nowait()
+        self.check_deadlock()
+
+    async def run_program(self, name):
+        program = self.programs[name]
+        while True:
+            event = program.run_until(self.time_slice)
+            if event == Event.output:
+                value = program.output.popleft()
+                self.last_outputs[name] = value
+                for dst in self.connections[name]:
+                    if dst not in self.finished:
+                        await self.put(name, dst, value)
+            elif event == Event.input:
+                program.input.append(await self.receive(name))
+            elif event == Event.halt:
+                break
+            else:
+                await asyncio.sleep(0)
+        self.finish(name)
+
+    async def run_async(self):
+        await asyncio.gather(*(self.run_program(name) for name in self.programs))
+
+    # Runs every program until it halts, returning the time taken in seconds
     def run(self):
-        while self.pc is not None:
-            self.pc = self.run_instruction()
-
-    def get_next_output(self):
-        initial_output_len = len(self.output)
-        while self.pc is not None and len(self.output) == initial_output_len:
-            self.pc = self.run_instruction()
-        if self.pc is None:
-            return None
-        else:
-            return self.output[-1]
-
-    @staticmethod
-    def parse_opcode(val):
-        val, opcode = divmod(val, 100)
-        modes = []
-        while val > 0:
-            val, mode = divmod(val, 10)
-            assert(mode in [0,1])
-            modes.append(bool(mode))
-        return (opcode, modes)
-
-    def get_parameter_value(self, i, modes):
-        return self.mem[self.pc+i+1] if modes[i] else self.mem[self.mem[self.pc+i+1]]
-
-    # Generic decorator to set up params, based on parameter modes
-    def opcode_template(num_params, output_params):
-        def decorator(func):
-            def inner(self, modes):
-                modes += [False] * (num_params - len(modes))
-                for i in output_params:
-                    # Output paramters are not actually immediate mode, but we want
-                    # to treat them as such: they return the output location, not
-                    # the value at the output location.
-                    modes[i] = True
-                params = [self.get_parameter_value(i, modes) for i in range(0, num_params)]
-                return func(self, params)
-            return inner
-        return decorator
-
-    @opcode_template(3, [2])
-    def opcode_add(self, params):
-        self.mem[params[2]] = params[0] + params[1]
-        return self.pc + len(params) + 1
-
-    @opcode_template(3, [2])
-    def opcode_multiply(self, params):
-        self.mem[params[2]] = params[0] * params[1]
-        return self.pc + len(params) + 1
-
-    @opcode_template(1, [0])
-    def opcode_input(self, params):
-        self.mem[params[0]] = self.input[self.input_offset]
-        self.input_offset += 1
-        return self.pc + len(params) + 1
-
-    @opcode_template(1, [])
-    def opcode_output(self, params):
-        self.output.append(params[0])
-        return self.pc + len(params) + 1
-
-    @opcode_template(2, [])
-    def opcode_jump_if_true(self, params):
-        return params[1] if params[0] != 0 else self.pc + len(params) + 1
-
-    @opcode_template(2, [])
-    def opcode_jump_if_false(self, params):
-        return params[1] if params[0] == 0 else self.pc + len(params) + 1
-
-    @opcode_template(3, [2])
-    def opcode_less_than(self, params):
-        self.mem[params[2]] = int(params[0] < params[1])
-        return self.pc + len(params) + 1
-
-    @opcode_template(3, [2])
-    def opcode_equals(self, params):
-        self.mem[params[2]] = int(params[0] == params[1])
-        return self.pc + len(params) + 1
-
-    @opcode_template(0, [])
-    def opcode_exit(self, modes):
-        return None
-
-    # Returns PC of next instruction, or None if program should exit
-    def run_instruction(self):
-        opcodes = {
-            1: self.opcode_add,
-            2: self.opcode_multiply,
-            3: self.opcode_input,
-            4: self.opcode_output,
-            5: self.opcode_jump_if_true,
-            6: self.opcode_jump_if_false,
-            7: self.opcode_less_than,
-            8: self.opcode_equals,
-            99: self.opcode_exit,
-        }
-
-        (opcode, modes) = self.parse_opcode(self.mem[self.pc])
-        if opcode not in opcodes:
-            raise Exception(f'Invalid opcode: {opcode}')
-        return opcodes[opcode](modes)
-
-def create_amps(mem, perm):
+        start = time.perf_counter()
+        asyncio.run(self.run_async())
+        self.elapsed = time.perf_counter() - start
+        return self.elapsed
+
+# Searches the tree of phase prefixes depth first, returning the best final
+# signal. Permutations that share a prefix share the amplifier runs for it.
+# run_amp(phase, signal) returns the output of a new amplifier given its
+# phase and input signal, and the amplifier after it, and finish(perm, amps,
+# signal) the final signal of a whole permutation from its amplifiers and
+# the last one's output.
+def search_prefixes(phases, run_amp, finish, perm=(), amps=(), signal=0):
+    if not phases:
+        return finish(perm, amps, signal)
+    best = None
+    for phase in sorted(phases):
+        (output, amp) = run_amp(phase, signal)
+        final = search_prefixes(phases - {phase}, run_amp, finish, perm + (phase,), amps + (amp,), output)
+        best = final if best is None else max(best, final)
+    return best
+
+# Returns a run_amp for search_prefixes, which starts a new amplifier for
+# every call. The tree already shares the runs of common prefixes, so this
+# only keeps the amplifiers on the current path, for searches too big to
+# memoize.
+def start_amps(mem):
+    snapshot = warm_snapshot(mem, Feature.io)
+    def run_amp(phase, signal):
+        amp = snapshot.fork()
+        amp.input.extend([phase, signal])
+        return (amp.get_next_output(), amp)
+    return run_amp
+
+# Returns a run_amp for search_prefixes, which memoizes the output and
+# amplifier of each (phase, signal). The amplifiers are shared, so mustn't be
+# run any further. With a RunCache, outputs are looked up in it instead, and
+# no amplifiers are kept.
+def memoize_amps(mem, cache=None):
+    start_amp = start_amps(mem)
+    results = {}
+    def run_amp(phase, signal):
+        result = results.get((phase, signal))
+        if result is None:
+            if cache is not None:
+                result = (cache.run(mem, [phase, signal], Feature.io).output[0], None)
+            else:
+                result = start_amp(phase, signal)
+            results[(phase, signal)] = result
+        return result
+    return run_amp
+
+def get_max_final_signal(mem, cache=None, num_amplifiers=5):
+    run_amp = memoize_amps(mem, cache)
+    return search_prefixes(frozenset(range(num_amplifiers)), run_amp, lambda perm, amps, signal: signal)
+
+# Adds a feedback loop to the network as a ring of forks of amps, which
+# have each taken their first input, named by perm and their position in it.
+# signal, the last amplifier's first output, is sent round to the first.
+def add_feedback_loop(network, perm, amps, signal):
+    for i, amp in enumerate(amps):
+        network.add((perm, i), amp.fork())
+        network.connect((perm, i), (perm, (i + 1) % len(amps)))
+    network.send((perm, 0), signal)
+
+# Runs the rest of each (perm, amps, signal) feedback loop on one network,
+# returning the final signal of each perm
+def run_feedback_loops(loops):
+    network = Network()
+    for perm, amps, signal in loops:
+        add_feedback_loop(network, perm, amps, signal)
+    network.run()
+    return {perm: network.last_outputs.get((perm, len(perm) - 1), signal) for perm, amps, signal in loops}
+
+# Returns a finish for search_prefixes that collects each permutation's
+# amplifiers and signal after the first pass into loops
+def collect_loops(loops):
+    def finish(perm, amps, signal):
+        loops.append((perm, amps, signal))
+        return signal
+    return finish
+
+# Searches the permutations' first passes through the loop as a tree of
+# phase prefixes, then finishes every loop from there on one network. With
+# a RunCache, the final signal of each permutation is looked up in it
+# instead.
+def get_max_final_signal_with_feedback(mem, cache=None, num_amplifiers=5):
+    phases = range(5, 5 + num_amplifiers)
+    if cache is not None:
+        perms = list(itertools.permutations(phases))
+        signals = [cache.get('amplifier feedback loop', mem, perm) for perm in perms]
+        if all(signal is not None for signal in signals):
+            return max(signal[0] for signal in signals)
+
+    loops = []
+    search_prefixes(frozenset(phases), memoize_amps(mem), collect_loops(loops))
+    signals = run_feedback_loops(loops)
+    if cache is not None:
+        for perm, signal in signals.items():
+            cache.put('amplifier feedback loop', mem, perm, [signal])
+    return max(signals.values())
+
+# Set in each worker by init_feedback_worker
+feedback_run_amp = None
+
+def init_feedback_worker(mem):
+    global feedback_run_amp
+    feedback_run_amp = start_amps(mem)
+
+# Returns the best final signal of the feedback loops whose permutations
+# start with prefix
+def search_feedback_prefix(prefix, phases):
+    (amps, signal) = ((), 0)
+    for phase in prefix:
+        (signal, amp) = feedback_run_amp(phase, signal)
+        amps += (amp,)
+    loops = []
+    search_prefixes(frozenset(phases) - set(prefix), feedback_run_amp, collect_loops(loops), prefix, amps, signal)
+    return max(run_feedback_loops(loops).values())
+
+# Like get_max_final_signal_with_feedback, but searching on a pool of worker
+# processes, for more amplifiers than one core can get through. The
+# permutations are split by their first prefix_length phases, each worker is
+# given the program once, and the best signal is kept as the results come in.
+def get_max_final_signal_with_feedback_parallel(mem, num_amplifiers=5, workers=None, prefix_length=2):
+    phases = tuple(range(5, 5 + num_amplifiers))
+    prefixes = itertools.permutations(phases, min(prefix_length, num_amplifiers))
+    best = None
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_feedback_worker, initargs=(list(mem),)) as executor:
+        futures = [executor.submit(search_feedback_prefix, prefix, phases) for prefix in prefixes]
+        for future in concurrent.futures.as_completed(futures):
+            signal = future.result()
+            best = signal if best is None else max(best, signal)
+    return best
+
+# Batch version of the amplifier searches, running every permutation as a
+# lane of one BatchProgram per amplifier. Without feedback, the signal
+# only goes through the amplifiers once. Raises if any lane stops on an
+# error, as the other searches would.
+def get_final_signals_batch(mem, perms, feedback):
+    perms = np.array(perms)
     amps = []
-    for i in range(len(perm)):
-        amp = Program(mem.copy(), [perm[i]])
+    for phases in perms.T:
+        amp = BatchProgram(mem, len(perms))
+        amp.send(phases)
         amps.append(amp)
-    return amps
 
-def get_next_signal(amps, signal):
+    signal = np.zeros(len(perms), dtype=np.int64)
+    final_signal = signal.copy()
+    running = np.ones(len(perms), dtype=bool)
+    while running.any():
+        for amp in amps:
+            amp.send(signal)
+            (signal, produced) = amp.get_next_output()
+            running &= produced
+        final_signal[running] = signal[running]
+        if not feedback:
+            break
     for amp in amps:
-        amp.input.append(signal)
-        signal = amp.get_next_output()
-    return signal
+        if amp.errored.any():
+            raise Exception(amp.errors[np.flatnonzero(amp.errored)[0]])
+    return final_signal
 
-def get_final_signal(mem, perm):
-    amps = create_amps(mem, perm)
-    return get_next_signal(amps, 0)
-
-def get_max_final_signal(mem):
+def get_max_final_signal_batch(mem, feedback=False):
     num_amplifiers = 5
-    perms = itertools.permutations(range(num_amplifiers))
-    return max(get_final_signal(mem, perm) for perm in perms)
-
-def get_final_signal_with_feedback(mem, perm, initial_signal):
-    amps = create_amps(mem, perm)
-    signal = 0
-
-    while True:
-        new_signal = get_next_signal(amps, signal)
-        if new_signal is None:
-            return signal
-        signal = new_signal
-
-def get_max_final_signal_with_feedback(mem):
-    num_amplifiers = 5
-    perms = itertools.permutations(range(num_amplifiers, num_amplifiers*2))
-    return max(get_final_signal_with_feedback(mem, perm, 0) for perm in perms)
+    if feedback:
+        perms = itertools.permutations(range(num_amplifiers, num_amplifiers*2))
+    else:
+        perms = itertools.permutations(range(num_amplifiers))
+    return int(get_final_signals_batch(mem, list(perms), feedback).max())
 
 class Test(unittest.TestCase):
     def run_test(self, mem, output_mem, input_='', output=''):
-        program = Program(mem, input_)
+        program = create_program(mem, input_, Feature.io)
         program.run()
         if output_mem is not None:
             self.assertEqual(program.mem, output_mem)
         if output:
-            self.assertEqual(program.output, output)
+            self.assertEqual(list(program.output), output)
 
     def test_run_program(self):
         self.run_test([1,0,0,0,99], [2,0,0,0,99])
@@ -202,16 +329,89 @@ class Test(unittest.TestCase):
 
         mem = read_input()
         self.assertEqual(get_max_final_signal(mem), 46248)
+        cache = RunCache.from_env()
+        if cache is not None:
+            self.assertEqual(get_max_final_signal(mem, cache), 46248)
 
     def test_get_max_final_signal_with_feedback(self):
         self.assertEqual(get_max_final_signal_with_feedback([3,26,1001,26,-4,26,3,27,1002,27,2,27,1,27,26,27,4,27,1001,28,-1,28,1005,28,6,99,0,0,5]), 139629729)
         self.assertEqual(get_max_final_signal_with_feedback([3,52,1001,52,-5,52,3,53,1,52,56,54,1007,54,5,55,1005,55,26,1001,54,-5,54,1105,1,12,1,53,54,53,1008,54,0,55,1001,55,1,55,2,53,55,53,4,53,1001,56,-1,56,1005,56,6,99,0,0,0,0,10]), 18216)
 
         mem = read_input()
-        self.assertEqual(get_max_final_signal_with_feedback(mem), 54163586)
+        self.assertEqual(get_max_final_signal_with_feedback(mem, RunCache.from_env()), 54163586)
+
+    def test_get_max_final_signal_with_feedback_parallel(self):
+        mem = [3,26,1001,26,-4,26,3,27,1002,27,2,27,1,27,26,27,4,27,1001,28,-1,28,1005,28,6,99,0,0,5]
+        self.assertEqual(get_max_final_signal_with_feedback_parallel(mem, workers=2), 139629729)
+        # More amplifiers than phases in a prefix, and fewer
+        self.assertEqual(get_max_final_signal_with_feedback_parallel(mem, 6, 2, 3), get_max_final_signal_with_feedback(mem, num_amplifiers=6))
+        self.assertEqual(get_max_final_signal_with_feedback_parallel(mem, 1, 2), get_max_final_signal_with_feedback(mem, num_amplifiers=1))
+
+        self.assertEqual(get_max_final_signal_with_feedback_parallel(read_input(), workers=2), 54163586)
+
+    def test_network(self):
+        double = [3,9,1002,9,2,9,4,9,99,0]
+        increment = [3,9,1001,9,1,9,4,9,99,0]
+
+        # A chain feeding a broadcast
+        network = Network()
+        network.add('a', create_program(increment.copy(), [1], Feature.io))
+        network.add('b', create_program(double.copy(), features=Feature.io))
+        network.add('c', create_program(increment.copy(), features=Feature.io))
+        network.add('d', create_program(double.copy(), features=Feature.io))
+        network.connect('a', 'b')
+        network.connect('b', 'c')
+        network.connect('b', 'd')
+        network.run()
+        self.assertEqual(network.last_outputs, {'a': 2, 'b': 4, 'c': 5, 'd': 8})
+        self.assertFalse(network.programs['c'].output)
+
+        # A ring where both programs wait for each other
+        network = Network()
+        network.add('a', create_program(double.copy(), features=Feature.io))
+        network.add('b', create_program(double.copy(), features=Feature.io))
+        network.connect('a', 'b')
+        network.connect('b', 'a')
+        with self.assertRaisesRegex(Exception, 'waiting for input'):
+            network.run()
+
+        # A ring where both programs fill the other's inbox before reading
+        chatty = [104,1] * 20 + [3,0,99]
+        network = Network()
+        network.add('a', create_program(chatty.copy(), features=Feature.io))
+        network.add('b', create_program(chatty.copy(), features=Feature.io))
+        network.connect('a', 'b')
+        network.connect('b', 'a')
+        with self.assertRaisesRegex(Exception, r"\['a', 'b'\] waiting to send"):
+            network.run()
+
+        # An amplifier feedback loop
+        mem = [3,26,1001,26,-4,26,3,27,1002,27,2,27,1,27,26,27,4,27,1001,28,-1,28,1005,28,6,99,0,0,5]
+        amps = [create_program(mem.copy(), [phase], Feature.io) for phase in [9,8,7,6,5]]
+        network = Network()
+        add_feedback_loop(network, 'loop', amps, 0)
+        network.run()
+        self.assertEqual(network.last_outputs[('loop', 4)], 139629729)
+
+    @unittest.skipIf(np is None, 'requires numpy')
+    def test_get_max_final_signal_batch(self):
+        self.assertEqual(get_max_final_signal_batch([3,15,3,16,1002,16,10,16,1,16,15,15,4,15,99,0,0]), 43210)
+        self.assertEqual(get_max_final_signal_batch([3,31,3,32,1002,32,10,32,1001,31,-2,31,1007,31,0,33,1002,33,7,33,1,33,31,31,1,32,31,31,4,31,99,0,0,0]), 65210)
+        self.assertEqual(get_max_final_signal_batch([3,52,1001,52,-5,52,3,53,1,52,56,54,1007,54,5,55,1005,55,26,1001,54,-5,54,1105,1,12,1,53,54,53,1008,54,0,55,1001,55,1,55,2,53,55,53,4,53,1001,56,-1,56,1005,56,6,99,0,0,0,0,10], True), 18216)
+
+        mem = read_input()
+        self.assertEqual(get_max_final_signal_batch(mem), 46248)
+        self.assertEqual(get_max_final_signal_batch(mem, True), 54163586)
+
+        # Reads the phase, then adds a cell past the end of memory to it
+        with self.assertRaisesRegex(Exception, 'Address past the end of memory: 100'):
+            get_max_final_signal_batch([3,0,1,0,100,0,99])
 
 if __name__ == '__main__':
     unittest.main(exit=False)
 
     mem = read_input()
-    print(get_max_final_signal_with_feedback(mem))
+    cache = RunCache.from_env()
+    print(get_max_final_signal_with_feedback(mem, cache))
+    if cache is not None:
+        print(cache.report())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Measures instructions per second of the Program in one or more engine files,
+# running the BOOST program in both of its modes. To compare against an older
+# revision of the engine:
+#
+#   git show HEAD~1:intcode/engine.py > /tmp/engine_old.py
+#   ./microbench.py ../intcode/engine.py /tmp/engine_old.py
+
+import importlib.util
+import os
+import sys
+import time
+
+ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'intcode', 'engine.py')
+
+def load_engine(path):
+    spec = importlib.util.spec_from_file_location(os.path.basename(path)[:-3], path)
+    engine = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(engine)
+    return engine
+
+# Counts the instructions a run executes, by running them one at a time
+def count_instructions(engine, mem, input_):
+    program = engine.Program(mem.copy(), input_)
+    count = 0
+    while True:
+        event = program.run_until(max_steps=1)
+        if event == engine.Event.input:
+            raise Exception('Program needs more input')
+        count += 1
+        if event == engine.Event.halt:
+            return count
+
+def time_run(engine, mem, input_, translate, repeat):
+    best = None
+    for _ in range(repeat):
+        if translate:
+            program = engine.Program(mem.copy(), input_, translate=True)
+        else:
+            program = engine.Program(mem.copy(), input_)
+        start = time.perf_counter()
+        program.run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(paths, repeat=3):
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    current = load_engine(ENGINE)
+    mem = current.read_input()
+    workloads = [('BOOST test mode', [1]), ('BOOST sensor mode', [2])]
+    counts = {name: count_instructions(current, mem, input_) for name, input_ in workloads}
+
+    print(f'{"engine":<24} {"workload":<20} {"mode":<12} {"time (s)":>10} {"instr/s":>12}')
+    for path in paths:
+        engine = load_engine(os.path.abspath(path))
+        for name, input_ in workloads:
+            for translate in [False, True]:
+                try:
+                    elapsed = time_run(engine, mem, input_, translate, repeat)
+                except TypeError:
+                    # Engines from before translate mode existed
+                    continue
+                mode = 'translated' if translate else 'interpreted'
+                print(f'{os.path.relpath(path):<24} {name:<20} {mode:<12} {elapsed:>10.3f} {counts[name] / elapsed:>12,.0f}')
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or [ENGINE])
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+# Benchmarks every configuration of the Intcode engine on a fixed corpus of
+# programs, and compares the results with a stored baseline:
+#
+#   ./bench.py                 # run and compare against baseline.json
+#   ./bench.py --save          # run and store the results as the new baseline
+#   ./bench.py --engine lean   # only engines whose name starts with lean
+#
+# The corpus is the test programs embedded in the Test classes, the real
+# programs from days 9, 11 and 13, and synthetic long-running loops. Each
+# engine runs every program that only needs the features it supports. Each
+# entry is run as many times as it takes to fill at least 0.2s, as timeit
+# does, so corpora that take well under a millisecond aren't timed against
+# the resolution of the clock.
+#
+# Translated engines summarize counting loops, skipping the instructions in
+# them, so instructions/s means nothing for a corpus with such a loop. Those
+# results are listed separately, with the steps the engine took instead, and
+# compared with the baseline by time. Exits with status 1 if any result is slower
+# than the baseline by more than the tolerance, or gives different output
+# from a profiled run of Program.
+
+import argparse
+import ast
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+sys.path.insert(0, ROOT)
+from intcode import Feature, Memory, Program, create_program, read_input
+
+def read_program(day):
+    return read_input(os.path.join(ROOT, day, 'input.txt'))
+
+# Returns the (mem, input) of every run_test call with literal arguments in
+# the Test class of a file
+def test_programs(path):
+    with open(os.path.join(ROOT, path)) as f:
+        tree = ast.parse(f.read())
+    programs = []
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)):
+            continue
+        if node.func.attr != 'run_test' or not node.args:
+            continue
+        try:
+            args = [ast.literal_eval(arg) for arg in node.args]
+        except ValueError:
+            continue
+        input_ = args[2] if len(args) > 2 and args[2] else []
+        programs.append((args[0], list(input_)))
+    return programs
+
+# Counts down from n to 0, using only position and immediate mode
+def countdown_program(n):
+    mem = [1101,0,n,20, 1001,20,-1,20, 1005,20,4, 4,20, 99]
+    return mem + [0] * (21 - len(mem))
+
+# Sums 1..n with the counter and total on a relative-mode stack
+def sum_program(n):
+    return [109,1000, 21101,0,n,0, 22201,0,1,1, 21201,0,-1,0, 1205,0,6, 204,1, 99]
+
+# Each entry is a name, the features it needs, and a list of (mem, input)
+def get_corpus():
+    return [
+        ('tests 02', Feature.basic, test_programs('02/02.py')),
+        ('tests 05', Feature.io, test_programs('05/05.py')),
+        ('tests 07', Feature.io, test_programs('07/07.py')),
+        ('tests engine', Feature.relative, test_programs('intcode/engine.py')),
+        ('countdown loop', Feature.io, [(countdown_program(100000), [])]),
+        ('relative sum loop', Feature.relative, [(sum_program(50000), [])]),
+        ('day 9 BOOST test', Feature.relative, [(read_program('09'), [1])]),
+        ('day 9 BOOST sensor', Feature.relative, [(read_program('09'), [2])]),
+        ('day 11 robot, all black', Feature.relative, [(read_program('11'), [0] * 10000)]),
+        ('day 13 game screen', Feature.relative, [(read_program('13'), [])]),
+    ]
+
+# Name, features and constructor, taking (mem, input), of each engine
+ENGINES = [
+    ('lean', Feature.io, lambda mem, input_: create_program(mem, input_, Feature.io)),
+    ('lean translated', Feature.io, lambda mem, input_: create_program(mem, input_, Feature.io, translate=True)),
+    ('full', Feature.relative, lambda mem, input_: Program(mem, input_)),
+    ('full translated', Feature.relative, lambda mem, input_: Program(mem, input_, translate=True)),
+    ('full typed', Feature.relative, lambda mem, input_: Program(Memory(mem, typed=True), input_)),
+]
+
+# Runs a program with profiling, returning its outputs and the number of
+# instructions executed
+def run_reference(mem, input_):
+    program = Program(list(mem), list(input_), profile=True)
+    program.run()
+    return (list(program.output), sum(program.profile.opcode_counts.values()))
+
+# Runs the programs, returning their outputs and the steps they took
+def run_all(create, programs, summarize_loops=True):
+    outputs = []
+    steps = 0
+    for mem, input_ in programs:
+        program = create(list(mem), list(input_))
+        program.summarize_loops = summarize_loops
+        program.run()
+        outputs.append(list(program.output))
+        steps += program.steps
+    return (outputs, steps)
+
+# Returns the best time of one run of the programs, their peak memory use,
+# their outputs and the steps they took. The time is the best of repeat
+# timings of enough runs to fill 0.2s.
+def measure(create, programs, repeat):
+    timer = timeit.Timer(lambda: run_all(create, programs))
+    (loops, _) = timer.autorange()
+    best = min(timer.repeat(repeat, loops)) / loops
+
+    tracemalloc.start()
+    (outputs, steps) = run_all(create, programs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (best, peak, outputs, steps)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', action='append', help='only run engines starting with this name')
+    parser.add_argument('--repeat', type=int, default=3, help='timings to take the best from')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown allowed before flagging a regression')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    args = parser.parse_args()
+
+    corpus = []
+    for name, features, programs in get_corpus():
+        expected = [run_reference(mem, input_) for mem, input_ in programs]
+        instructions = sum(count for _, count in expected)
+        corpus.append((name, features, programs, [outputs for outputs, _ in expected], instructions))
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    results = {}
+    failed = False
+    summarized = []
+    print(f'{"engine":<16} {"program":<24} {"time (s)":>9} {"instr/s":>11} {"peak KiB":>9} {"baseline":>11} {"change":>7}')
+    for engine_name, engine_features, create in ENGINES:
+        if args.engine and not any(engine_name.startswith(prefix) for prefix in args.engine):
+            continue
+        for name, features, programs, expected, instructions in corpus:
+            if features > engine_features:
+                continue
+            (elapsed, peak, outputs, steps) = measure(create, programs, args.repeat)
+            key = f'{engine_name}: {name}'
+            result = {
+                'time': elapsed,
+                'instructions': instructions,
+                'steps': steps,
+                'peak_bytes': peak,
+            }
+            # Only translated engines take fewer steps with loop summaries
+            if steps < run_all(create, programs, summarize_loops=False)[1]:
+                result['summarized'] = True
+            else:
+                result['ips'] = instructions / elapsed
+            results[key] = result
+
+            flags = []
+            if outputs != expected:
+                flags.append('WRONG OUTPUT')
+            old = baseline.get(key)
+            if old:
+                change = old['time'] / elapsed - 1
+                if change < -args.tolerance:
+                    flags.append('REGRESSION')
+            failed |= bool(flags)
+
+            if 'summarized' in result:
+                old_time = f'{old["time"]:>12.4f} {change:>+7.0%}' if old else f'{"-":>12} {"":>7}'
+                summarized.append(f'{engine_name:<16} {name:<24} {elapsed:>9.4f} {steps:>11,} {peak / 1024:>9.0f} {old_time} {" ".join(flags)}')
+                continue
+            if old and 'ips' in old:
+                comparison = f'{old["ips"]:>11,.0f} {change:>+7.0%}'
+            else:
+                comparison = f'{"-":>11} {"":>7}'
+            print(f'{engine_name:<16} {name:<24} {elapsed:>9.4f} {result["ips"]:>11,.0f} {peak / 1024:>9.0f} {comparison} {" ".join(flags)}')
+
+    if summarized:
+        print()
+        print('Summarized loops, which skip instructions, by steps taken:')
+        print(f'{"engine":<16} {"program":<24} {"time (s)":>9} {"steps":>11} {"peak KiB":>9} {"baseline (s)":>12} {"change":>7}')
+        for line in summarized:
+            print(line)
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
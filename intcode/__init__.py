@@ -0,0 +1,17 @@
+from .engine import (
+    Channel,
+    Event,
+    Feature,
+    LeanProgram,
+    Memory,
+    ParameterMode,
+    Profile,
+    Program,
+    create_program,
+    print_mem,
+)
+from .image import Image, compile_image, load_image, read_input
+from .checkpoint import Checkpoint, dump_program, load_checkpoint, load_program, save_checkpoint
+from .lockstep import BatchProgram
+from .memo import RunCache, RunResult, memory_digest
+from .warm import WarmStarts, get_warm_starts, warm_snapshot, warm_start
@@ -0,0 +1,175 @@
+# Runs one program over many inputs on a pool of worker processes.
+#
+#   python -m intcode.batch program.txt inputs.jsonl > results.jsonl
+#   python -m intcode.batch program.txt inputs.jsonl --workers 8 --unordered
+#
+# Each line of the inputs file is a JSON list of the input values for one
+# run. Each line of the results is a JSON object with the run's index in the
+# inputs, its input, its outputs, the event it stopped on and the steps it
+# took, or an error:
+#
+#   {"index": 0, "input": [1], "output": [3335138414], "event": "halt", "steps": 207}
+#   {"index": 1, "input": [], "error": "Invalid opcode: 12"}
+#
+# The program is sent to each worker once, when it starts, and each worker
+# starts every run from the program's warm start. Inputs are sent to the
+# workers in chunks, with a few chunks per worker in flight at a time, so
+# the inputs are read as the results are written rather than all at once.
+# Results come back in input order, or as they complete with --unordered.
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import sys
+import tempfile
+import unittest
+from collections import deque
+
+from .engine import Event, Feature
+from .image import read_input
+from .warm import start_from, warm_snapshot
+
+# Chunks in flight per worker
+chunks_per_worker = 4
+
+# Set in each worker by init_worker
+worker_mem = None
+worker_config = None
+worker_max_steps = None
+# Set by the first run in each worker
+worker_snapshot = None
+
+def init_worker(mem, features, translate, max_steps):
+    global worker_mem, worker_config, worker_max_steps, worker_snapshot
+    worker_mem = mem
+    worker_config = (features, translate)
+    worker_max_steps = max_steps
+    worker_snapshot = None
+
+# Runs the program on one input, returning its result. The warm start is
+# taken by the first run that needs it, so an error in the prologue is
+# reported for each input rather than breaking the worker.
+def run_input(index, input_):
+    global worker_snapshot
+    result = {'index': index, 'input': input_}
+    try:
+        if worker_snapshot is None:
+            worker_snapshot = warm_snapshot(worker_mem, *worker_config)
+        program = start_from(worker_snapshot, worker_mem, input_, worker_max_steps)
+        while True:
+            budget = None if worker_max_steps is None else max(worker_max_steps - program.steps, 0)
+            event = program.run_until(budget)
+            if event != Event.output:
+                break
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+    result.update(output=list(program.output), event=event.name, steps=program.steps)
+    return result
+
+def run_chunk(chunk):
+    return [run_input(index, input_) for index, input_ in chunk]
+
+# Runs mem on every input, yielding the result of each. Results are yielded
+# in the order of the inputs, unless ordered is False, when they are
+# yielded as they complete.
+def run_batch(mem, inputs, workers=None, chunk_size=64, ordered=True, features=Feature.relative, translate=False, max_steps=None):
+    workers = workers or os.cpu_count() or 1
+    indexed = enumerate(map(list, inputs))
+    chunks = iter(lambda: list(itertools.islice(indexed, chunk_size)), [])
+    initargs = (list(mem), features, translate, max_steps)
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker, initargs=initargs) as executor:
+        pending = deque(executor.submit(run_chunk, chunk) for chunk in itertools.islice(chunks, workers * chunks_per_worker))
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                (done, _) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+            for future in done:
+                for chunk in itertools.islice(chunks, 1):
+                    pending.append(executor.submit(run_chunk, chunk))
+                yield from future.result()
+
+# Yields the input vectors of a JSONL file, skipping blank lines
+def read_inputs(f):
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs an Intcode program on every input vector of a JSONL file')
+    parser.add_argument('program', help='program source')
+    parser.add_argument('inputs', help="JSONL file of input vectors, or '-' for stdin")
+    parser.add_argument('-o', '--output', help='file to write the results to (default: stdout)')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=64, help='inputs sent to a worker at a time')
+    parser.add_argument('--unordered', action='store_true', help='write results as they complete')
+    parser.add_argument('--steps', type=int, help='step budget for each run')
+    parser.add_argument('--features', choices=[feature.name for feature in Feature], default=Feature.relative.name)
+    parser.add_argument('--translate', action='store_true', help='translate basic blocks to Python')
+    args = parser.parse_args(argv)
+
+    mem = read_input(args.program)
+    inputs = sys.stdin if args.inputs == '-' else open(args.inputs)
+    output = sys.stdout if args.output is None else open(args.output, 'w')
+    try:
+        results = run_batch(mem, read_inputs(inputs), args.workers, args.chunk_size, not args.unordered,
+                            Feature[args.features], args.translate, args.steps)
+        for result in results:
+            output.write(json.dumps(result) + '\n')
+    finally:
+        if inputs is not sys.stdin:
+            inputs.close()
+        if output is not sys.stdout:
+            output.close()
+
+class Test(unittest.TestCase):
+    # Outputs its input times 3
+    triple = [3,9,1002,9,3,9,4,9,99,0]
+
+    def test_run_batch(self):
+        inputs = [[i] for i in range(200)]
+        results = list(run_batch(self.triple, inputs, workers=2, chunk_size=7))
+        self.assertEqual([result['index'] for result in results], list(range(200)))
+        self.assertEqual([result['output'] for result in results], [[i * 3] for i in range(200)])
+        self.assertEqual(results[0], {'index': 0, 'input': [0], 'output': [0], 'event': 'halt', 'steps': 4})
+
+        results = list(run_batch(self.triple, inputs, workers=2, chunk_size=7, ordered=False, translate=True))
+        self.assertEqual(sorted((result['index'], result['output']) for result in results), [(i, [i * 3]) for i in range(200)])
+
+    def test_errors_and_budget(self):
+        # Loops while its input is non-zero
+        results = list(run_batch([3,9,1005,9,2,99], [[1], [0], []], workers=1, max_steps=10))
+        self.assertEqual([(result['event'], result['steps']) for result in results], [('budget', 10), ('halt', 3), ('input', 0)])
+
+        # Runs its input as an instruction
+        results = list(run_batch([3,5,1105,1,5,0], [[99], [12]], workers=1))
+        self.assertEqual(results[0]['event'], 'halt')
+        self.assertEqual(results[1]['error'], 'Invalid opcode: 12')
+
+        # Fails before reading any input
+        results = list(run_batch([12,0,99], [[1], [2]], workers=1))
+        self.assertEqual([result['error'] for result in results], ['Invalid opcode: 12'] * 2)
+
+        # More input than fits in a default channel
+        results = list(run_batch([3,0,99], [list(range(2000))], workers=1))
+        self.assertEqual(results[0]['event'], 'halt')
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as dir_:
+            paths = [os.path.join(dir_, name) for name in ['input.txt', 'inputs.jsonl', 'results.jsonl']]
+            with open(paths[0], 'w') as f:
+                f.write(','.join(map(str, self.triple)) + '\n')
+            with open(paths[1], 'w') as f:
+                f.write('[1]\n\n[2]\n[-5]\n')
+            main([paths[0], paths[1], '-o', paths[2], '--workers', '2', '--chunk-size', '1', '--features', 'io'])
+            with open(paths[2]) as f:
+                results = [json.loads(line) for line in f]
+        self.assertEqual([result['output'] for result in results], [[3], [6], [-15]])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# Checkpoints of running programs, so a run can be saved to disk and resumed
+# later, in this or another process.
+#
+# A checkpoint holds everything needed to carry on where the program left
+# off: its memory, pc, relative base and pending input and output, plus any
+# JSON metadata the caller wants to keep with it, such as the state of the
+# code driving the program. Decoded instructions and translated blocks aren't
+# saved, as they are rebuilt as the resumed program runs.
+#
+#   header    magic, version, flags, feature level
+#   payload   zlib compressed:
+#     state     pc, relative base, memory size
+#     pages     packed page indices, then packed cells of those pages
+#     input     packed pending input
+#     output    packed pending output
+#     metadata  JSON, to the end of the payload
+
+import json
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+from collections import namedtuple
+
+from .engine import Feature, LeanProgram, Memory, Program, create_program
+from .image import pack_values, unpack_values, values_to_list, write_file
+
+MAGIC = b'ICCP'
+VERSION = 1
+HEADER = struct.Struct('<4sHBB')
+STATE = struct.Struct('<qqQ')
+
+# Flags
+TRANSLATE = 1
+TYPED = 2
+LEAN = 4
+HALTED = 8
+
+Checkpoint = namedtuple('Checkpoint', ['program', 'metadata'])
+
+# Returns the checkpoint bytes of a program
+def dump_program(program, metadata=None):
+    mem = program.mem
+    flags = 0
+    if program.translate:
+        flags |= TRANSLATE
+    if isinstance(program, LeanProgram):
+        flags |= LEAN
+    if program.pc is None:
+        flags |= HALTED
+    if isinstance(mem, Memory):
+        if mem.typed:
+            flags |= TYPED
+        indices = sorted(mem.pages)
+        cells = [val for index in indices for val in mem.pages[index]]
+    else:
+        # A lean program's plain list is saved as its cells, with no pages
+        indices = []
+        cells = list(mem)
+
+    payload = b''.join([
+        STATE.pack(program.pc or 0, program.relative_base, len(mem)),
+        pack_values(indices),
+        pack_values(cells),
+        pack_values(list(program.input)),
+        pack_values(list(program.output)),
+        json.dumps(metadata).encode(),
+    ])
+    return HEADER.pack(MAGIC, VERSION, flags, program.features) + zlib.compress(payload)
+
+# Returns the program, and the metadata it was saved with, from checkpoint
+# bytes
+def load_program(data):
+    (magic, version, flags, features) = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise Exception('Not an Intcode checkpoint')
+    payload = zlib.decompress(data[HEADER.size:])
+    (pc, relative_base, size) = STATE.unpack_from(payload)
+    (indices, overflow, offset) = unpack_values(payload, STATE.size)
+    indices = values_to_list(indices, overflow)
+    (cells, cells_overflow, offset) = unpack_values(payload, offset)
+    (input_, overflow, offset) = unpack_values(payload, offset)
+    input_ = values_to_list(input_, overflow)
+    (output, overflow, offset) = unpack_values(payload, offset)
+    output = values_to_list(output, overflow)
+    metadata = json.loads(payload[offset:])
+
+    if flags & LEAN:
+        mem = values_to_list(cells, cells_overflow)
+    else:
+        mem = Memory.from_buffer(cells, bool(flags & TYPED))
+        # from_buffer lays the cells out contiguously, so move each page to
+        # its real index
+        mem.pages = {index: mem.pages[i] for i, index in enumerate(indices)}
+        mem.owned = set(mem.pages)
+        for i, val in cells_overflow.items():
+            (page, cell) = divmod(i, Memory.page_size)
+            mem[indices[page] * Memory.page_size + cell] = val
+        mem.size = size
+
+    program = create_program(mem, input_, Feature(features), bool(flags & TRANSLATE))
+    program.pc = None if flags & HALTED else pc
+    program.relative_base = relative_base
+    program.output.extend(output)
+    return Checkpoint(program, metadata)
+
+def save_checkpoint(program, path, metadata=None):
+    write_file(path, dump_program(program, metadata))
+
+def load_checkpoint(path):
+    with open(path, 'rb') as f:
+        return load_program(f.read())
+
+class Test(unittest.TestCase):
+    # Runs a program until it has output count values, checkpoints it, and
+    # checks the resumed program gives the same remaining output as the
+    # original
+    def check_resume(self, program, count):
+        for _ in range(count):
+            program.run_until()
+        resumed = load_program(dump_program(program)).program
+        self.assertEqual(resumed.pc, program.pc)
+        self.assertEqual(resumed.mem, program.mem)
+        program.run()
+        resumed.run()
+        self.assertEqual(list(resumed.output), list(program.output))
+        return resumed
+
+    def test_resume(self):
+        quine = [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
+        for translate in [False, True]:
+            self.check_resume(Program(quine, translate=translate), 5)
+        self.check_resume(Program(Memory(quine, typed=True)), 5)
+
+        # Relative base, sparse memory and values beyond 64 bits
+        self.check_resume(Program([109,5,1102,4294967296,4294967296,1000000,4,1000000,204,-5,99]), 1)
+
+        # Pending input, on a lean program
+        program = create_program([3,11,3,12,1,11,12,13,4,13,99,0,0,0], [2**70, 5, 6], Feature.io)
+        program.run_until(max_steps=1)
+        resumed = self.check_resume(program, 0)
+        self.assertIsInstance(resumed, LeanProgram)
+        self.assertEqual(list(resumed.input), [6])
+
+    def test_halted(self):
+        program = Program([104,1,99])
+        program.run()
+        resumed = load_program(dump_program(program)).program
+        self.assertIsNone(resumed.pc)
+        self.assertEqual(list(resumed.output), [1])
+
+    def test_save_checkpoint(self):
+        program = Program([3,7,4,7,1105,1,0,0])
+        program.input.append(9)
+        program.run_until()
+        with tempfile.TemporaryDirectory() as dir_:
+            path = os.path.join(dir_, 'program.ckpt')
+            save_checkpoint(program, path, {'step': 1})
+            (resumed, metadata) = load_checkpoint(path)
+        self.assertEqual(metadata, {'step': 1})
+        self.assertEqual(list(resumed.output), [9])
+        resumed.input.append(10)
+        self.assertEqual(list(resumed.outputs()), [9, 10])
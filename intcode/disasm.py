@@ -0,0 +1,331 @@
+# Disassembles a program and builds its control-flow graph, to see where the
+# time goes in a program and what could be optimized.
+#
+#   python -m intcode.disasm 09/input.txt
+#   python -m intcode.disasm 13/input.txt --run --hot 10
+#   python -m intcode.disasm 09/input.txt --run 1 --dot > cfg.dot
+#
+# Code is found by following every path from pc 0. Jumps with an immediate
+# target are followed, and jumps whose condition is an immediate constant
+# only go one way. Jumps through memory, like returns from a subroutine,
+# can't be followed, so the cell after a jump is also taken to be code when
+# some instruction has its address as an immediate parameter: the return
+# address a caller pushes before jumping to the subroutine. With a profile,
+# every pc that was run is code too. Cells that aren't part of any
+# instruction found are data.
+#
+# Writes to a position mode address are known without running the program,
+# and are flagged as self-modifying when they land in code. Writes through
+# relative mode aren't known.
+
+import argparse
+import os
+import unittest
+from collections import namedtuple
+
+from .engine import ParameterMode, Program
+from .image import read_input
+
+MNEMONICS = {
+    1: 'add',
+    2: 'mul',
+    3: 'in',
+    4: 'out',
+    5: 'jnz',
+    6: 'jz',
+    7: 'lt',
+    8: 'eq',
+    9: 'arb',
+    99: 'hlt',
+}
+
+JUMPS = [5, 6]
+
+# The opcode table of Program, for the parameters of each opcode
+OPCODES = Program([]).get_opcodes()
+
+class Instruction(namedtuple('Instruction', ['pc', 'opcode', 'modes', 'params'])):
+    @property
+    def length(self):
+        return len(self.params) + 1
+
+    @property
+    def next_pc(self):
+        return self.pc + self.length
+
+    # The address the instruction writes to, if it is known statically
+    @property
+    def write_address(self):
+        for i in OPCODES[self.opcode].output_params:
+            if self.modes[i] == ParameterMode.position:
+                return self.params[i]
+        return None
+
+    # The pcs the instruction can go to next, and whether it can also go
+    # somewhere that isn't known statically
+    def successors(self):
+        if self.opcode == 99:
+            return ([], False)
+        if self.opcode not in JUMPS:
+            return ([self.next_pc], False)
+        (cond, target) = zip(self.modes, self.params)
+        targets = []
+        if cond[0] != ParameterMode.immediate or (cond[1] != 0) == (self.opcode == 6):
+            # The jump can fall through
+            targets.append(self.next_pc)
+        if cond[0] == ParameterMode.immediate and (cond[1] != 0) == (self.opcode == 6):
+            return (targets, False)
+        if target[0] != ParameterMode.immediate:
+            return (targets, True)
+        return (targets + [target[1]], False)
+
+    def format_param(self, mode, val):
+        if mode == ParameterMode.immediate:
+            return str(val)
+        elif mode == ParameterMode.relative:
+            return f'[rb{val:+d}]'
+        return f'[{val}]'
+
+    def __str__(self):
+        operands = ', '.join(self.format_param(mode, val) for mode, val in zip(self.modes, self.params))
+        return f'{MNEMONICS[self.opcode]:<4}{operands}'
+
+# Returns the instruction at pc, or None if the cells there aren't a valid
+# instruction
+def decode(mem, pc):
+    if not 0 <= pc < len(mem):
+        return None
+    (opcode, modes) = Program.parse_opcode(mem[pc])
+    if opcode not in MNEMONICS:
+        return None
+    num_params = OPCODES[opcode].num_params
+    if len(modes) > num_params or any(mode not in (0, 1, 2) for mode in modes) or pc + num_params >= len(mem):
+        return None
+    modes = [ParameterMode(mode) for mode in modes] + [ParameterMode.position] * (num_params - len(modes))
+    return Instruction(pc, opcode, modes, list(mem[pc+1:pc+1+num_params]))
+
+Block = namedtuple('Block', ['start', 'end', 'pcs', 'successors', 'indirect'])
+
+class Disassembly:
+    def __init__(self, mem, counts=None, entries=(0,)):
+        self.mem = list(mem)
+        # Runtime execution counts of each pc, from a Profile
+        self.counts = dict(counts or {})
+        self.instructions = {}
+        self.invalid = set()
+        self.find_code(set(entries) | set(self.counts))
+        self.code_cells = {addr for ins in self.instructions.values() for addr in range(ins.pc, ins.next_pc)}
+        self.blocks = self.find_blocks()
+        # The known address each instruction writes to, and the writes that
+        # land in code
+        self.writes = {}
+        for ins in self.instructions.values():
+            addr = ins.write_address
+            if addr is not None:
+                self.writes[ins.pc] = addr
+        self.self_modifying = {pc: addr for pc, addr in self.writes.items() if addr in self.code_cells}
+
+    def find_code(self, entries):
+        pending = list(entries)
+        while pending:
+            while pending:
+                pc = pending.pop()
+                if pc in self.instructions or pc in self.invalid:
+                    continue
+                ins = decode(self.mem, pc)
+                if ins is None:
+                    self.invalid.add(pc)
+                    continue
+                self.instructions[pc] = ins
+                pending += ins.successors()[0]
+
+            # Return addresses: the cells after jumps that some instruction
+            # has as an immediate parameter
+            after_jumps = {ins.next_pc for ins in self.instructions.values() if ins.opcode in JUMPS}
+            for ins in list(self.instructions.values()):
+                for mode, val in zip(ins.modes, ins.params):
+                    if mode == ParameterMode.immediate and val in after_jumps and val not in self.instructions and val not in self.invalid:
+                        pending.append(val)
+
+    def find_blocks(self):
+        leaders = {0}
+        for ins in self.instructions.values():
+            (targets, _) = ins.successors()
+            if ins.opcode in JUMPS or ins.opcode == 99:
+                leaders.update(targets)
+                leaders.add(ins.next_pc)
+        # Code reached other than by falling through, e.g. a return address
+        fallthroughs = {ins.next_pc for ins in self.instructions.values() if ins.opcode not in JUMPS + [99]}
+        leaders.update(pc for pc in self.instructions if pc not in fallthroughs)
+
+        blocks = {}
+        for start in sorted(leaders):
+            if start not in self.instructions:
+                continue
+            pcs = []
+            pc = start
+            while True:
+                ins = self.instructions[pc]
+                pcs.append(pc)
+                (targets, indirect) = ins.successors()
+                if ins.opcode in JUMPS or ins.opcode == 99 or ins.next_pc in leaders or ins.next_pc not in self.instructions:
+                    break
+                pc = ins.next_pc
+            successors = [target for target in targets if target in self.instructions]
+            blocks[start] = Block(start, ins.next_pc, pcs, successors, indirect)
+        return blocks
+
+    def data_ranges(self):
+        ranges = []
+        for addr in range(len(self.mem)):
+            if addr in self.code_cells:
+                continue
+            if ranges and ranges[-1][1] == addr:
+                ranges[-1][1] = addr + 1
+            else:
+                ranges.append([addr, addr + 1])
+        return [tuple(r) for r in ranges]
+
+    def block_count(self, block):
+        return self.counts.get(block.start, 0)
+
+    # Returns the blocks that ran the most instructions, with how many, most
+    # first
+    def hot_blocks(self, limit=10):
+        totals = [(block, sum(self.counts.get(pc, 0) for pc in block.pcs)) for block in self.blocks.values()]
+        totals = [(block, total) for block, total in totals if total]
+        return sorted(totals, key=lambda t: t[1], reverse=True)[:limit]
+
+    def to_listing(self):
+        lines = []
+        data = dict((start, end) for start, end in self.data_ranges())
+        addr = 0
+        while addr < len(self.mem):
+            if addr in data:
+                end = data[addr]
+                lines.append(f'{addr:>6}  data  {",".join(map(str, self.mem[addr:end]))}')
+                addr = end
+                continue
+            block = self.blocks.get(addr)
+            if block is not None:
+                successors = ', '.join(map(str, block.successors)) + (' ?' if block.indirect else '')
+                count = f', ran {self.block_count(block)}' if self.counts else ''
+                lines.append(f'; block {block.start}-{block.end - 1}{count} -> {successors or "halt"}')
+            ins = self.instructions.get(addr)
+            if ins is None:
+                # Overlaps an instruction decoded from an earlier cell
+                lines.append(f'{addr:>6}  data  {self.mem[addr]}')
+                addr += 1
+                continue
+            cells = ','.join(map(str, self.mem[ins.pc:ins.next_pc]))
+            notes = []
+            if ins.pc in self.counts:
+                notes.append(f'x{self.counts[ins.pc]}')
+            if ins.pc in self.self_modifying:
+                notes.append(f'writes code at {self.self_modifying[ins.pc]}')
+            line = f'{ins.pc:>6}  {cells:<28} {ins!s:<36}'
+            lines.append((line + ' ; ' + ', '.join(notes)) if notes else line.rstrip())
+            addr = ins.next_pc
+        return '\n'.join(lines)
+
+    # The control-flow graph in Graphviz format, with hot blocks shaded by
+    # how many instructions they ran
+    def to_dot(self):
+        lines = ['digraph cfg {', '    node [shape=box, fontname=monospace];']
+        hottest = max([total for _, total in self.hot_blocks(1)] or [0])
+        totals = dict((block.start, total) for block, total in self.hot_blocks(len(self.blocks)))
+        for block in self.blocks.values():
+            label = '\\l'.join(f'{pc}: {self.instructions[pc]}' for pc in block.pcs) + '\\l'
+            attrs = f'label="{label}"'
+            total = totals.get(block.start)
+            if total:
+                # White for cold blocks, through to red for the hottest
+                shade = 255 - int(200 * total / hottest)
+                attrs += f', style=filled, fillcolor="#ff{shade:02x}{shade:02x}", xlabel="{total}"'
+            lines.append(f'    b{block.start} [{attrs}];')
+            for succ in block.successors:
+                lines.append(f'    b{block.start} -> b{succ};')
+            if block.indirect:
+                lines.append(f'    b{block.start} -> indirect [style=dashed];')
+        if any(block.indirect for block in self.blocks.values()):
+            lines.append('    indirect [shape=point];')
+        lines.append('}')
+        return '\n'.join(lines)
+
+# Runs the program with profiling, returning its execution count for each
+# pc. Stops when it halts or needs more input than given.
+def profile_counts(mem, input_=None):
+    program = Program(list(mem), input_, profile=True)
+    program.run()
+    return dict(program.profile.pc_counts)
+
+class Test(unittest.TestCase):
+    def test_decode(self):
+        self.assertEqual(str(decode([1002,4,3,4], 0)), 'mul [4], 3, [4]')
+        self.assertEqual(str(decode([21101,1,-2,3], 0)), 'add 1, -2, [rb+3]')
+        self.assertEqual(str(decode([204,-1], 0)), 'out [rb-1]')
+        self.assertEqual(decode([21101,1,-2,3], 0).write_address, None)
+        self.assertEqual(decode([1101,1,-2,3], 0).write_address, 3)
+        # Invalid opcode or mode, or running off the end
+        self.assertIsNone(decode([12], 0))
+        self.assertIsNone(decode([30001,0,0,0], 0))
+        self.assertIsNone(decode([1,0,0], 0))
+
+    def test_disassembly(self):
+        # Counts down from 3, outputting each value, then halts. The data
+        # after the halt is the counter.
+        mem = [1101,0,3,15, 4,15, 1001,15,-1,15, 1005,15,4, 99, 7, 0]
+        dis = Disassembly(mem)
+        self.assertEqual(sorted(dis.instructions), [0, 4, 6, 10, 13])
+        self.assertEqual(dis.data_ranges(), [(14, 16)])
+        self.assertEqual(sorted(dis.blocks), [0, 4, 13])
+        self.assertEqual(dis.blocks[0].successors, [4])
+        self.assertEqual(dis.blocks[4].successors, [13, 4])
+        self.assertEqual(dis.writes, {0: 15, 6: 15})
+        self.assertEqual(dis.self_modifying, {})
+
+        counts = profile_counts(mem)
+        dis = Disassembly(mem, counts)
+        self.assertEqual(dis.block_count(dis.blocks[4]), 3)
+        self.assertEqual(dis.hot_blocks(1)[0][0].start, 4)
+        self.assertIn('; block 4-12, ran 3 -> 13, 4', dis.to_listing())
+        self.assertIn('b4 -> b4;', dis.to_dot())
+
+    def test_calls_and_self_modification(self):
+        # Pushes a return address and jumps to a subroutine, which returns
+        # through the stack. The caller then patches its own halt.
+        mem = [109,100, 21101,0,9,0, 1105,1,13, 1101,0,99,13, 2106,0,0]
+        dis = Disassembly(mem)
+        self.assertIn(9, dis.instructions)
+        self.assertTrue(dis.blocks[13].indirect)
+        self.assertEqual(dis.blocks[13].successors, [])
+        self.assertEqual(dis.self_modifying, {9: 13})
+        self.assertIn('writes code at 13', dis.to_listing())
+
+    def test_real_program(self):
+        mem = read_input(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '09', 'input.txt'))
+        # Everything that runs is found as code without a profile
+        dis = Disassembly(mem)
+        for input_ in [[1], [2]]:
+            self.assertLessEqual(set(profile_counts(mem, input_)), set(dis.instructions), input_)
+        self.assertTrue(Disassembly(mem, profile_counts(mem, [1])).to_listing())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Disassembles an Intcode program and builds its control-flow graph')
+    parser.add_argument('program', help='program source')
+    parser.add_argument('--run', nargs='*', type=int, metavar='INPUT', help='run the program on the given input and overlay its execution counts')
+    parser.add_argument('--dot', action='store_true', help='print the control-flow graph in Graphviz format')
+    parser.add_argument('--hot', type=int, metavar='N', help='print the N hottest blocks')
+    args = parser.parse_args()
+
+    mem = read_input(args.program)
+    counts = profile_counts(mem, args.run) if args.run is not None else None
+    dis = Disassembly(mem, counts)
+    if args.dot:
+        print(dis.to_dot())
+    elif args.hot:
+        total = sum(dis.counts.values())
+        for block, count in dis.hot_blocks(args.hot):
+            print(f'{block.start:>6}-{block.end - 1:<6} {count:>12} {count / total:>7.1%}')
+    else:
+        print(dis.to_listing())
@@ -0,0 +1,1212 @@
+# The Intcode engine shared by every day that runs Intcode programs.
+#
+# Program supports the full instruction set. Days that don't need relative
+# mode or memory growth can use LeanProgram, through create_program, which
+# dispatches on plain lists with a smaller instruction set.
+
+import functools
+import itertools
+import json
+import random
+import time
+import unittest
+from array import array
+from collections import Counter, OrderedDict, deque
+from enum import IntEnum
+
+# Instruction sets, each including the ones before it
+class Feature(IntEnum):
+    basic = 0     # add, multiply and exit
+    io = 1        # input, output, jumps and comparisons
+    relative = 2  # relative mode, adjusting the relative base, and memory growth
+
+class ParameterMode(IntEnum):
+    position = 0
+    immediate = 1
+    relative = 2
+    relative_output = 3
+
+# Reasons for Program.run_until to return
+class Event(IntEnum):
+    output = 0
+    input = 1
+    halt = 2
+    budget = 3
+
+def read_input(path='input.txt'):
+    with open(path) as f:
+        mem = list(map(int, f.read().split(',')))
+    return mem
+
+def print_mem(mem):
+    print(','.join(map(str, mem)))
+
+# Sparse memory, allocated in fixed-size pages the first time they are written.
+# Reads of cells that were never written return 0, so a program touching a
+# high address only costs a single page.
+#
+# When typed, pages are packed int64 arrays. A page is promoted to a list of
+# Python ints the first time a value that doesn't fit in 64 bits is written to
+# it, so arbitrarily large values still work.
+#
+# Forked memories share their pages until one of them writes to a page, which
+# then gets its own copy, so a fork only costs the pages it goes on to write.
+class Memory:
+    page_bits = 8
+    page_size = 1 << page_bits
+    page_mask = page_size - 1
+
+    def __init__(self, values=(), typed=False):
+        self.pages = {}
+        # Pages that aren't shared with a fork, so can be written in place
+        self.owned = set()
+        # Pages allocated because a write touched a new page
+        self.allocations = 0
+        self.typed = typed
+        # One past the highest address written, like the length of a list
+        self.size = len(values)
+        for start in range(0, len(values), self.page_size):
+            page = self.make_page(values[start:start+self.page_size])
+            page.extend([0] * (self.page_size - len(page)))
+            self.pages[start >> self.page_bits] = page
+            self.owned.add(start >> self.page_bits)
+
+    # Returns a memory holding a buffer of int64 cells, such as a memoryview
+    # of a mapped image. Pages are copied from the buffer in bulk rather than
+    # converting each value.
+    @classmethod
+    def from_buffer(cls, cells, typed=False):
+        mem = cls(typed=typed)
+        for start in range(0, len(cells), cls.page_size):
+            chunk = cells[start:start+cls.page_size]
+            if typed:
+                page = array('q')
+                page.frombytes(chunk.cast('B'))
+            else:
+                page = chunk.tolist()
+            page.extend([0] * (cls.page_size - len(page)))
+            mem.pages[start >> cls.page_bits] = page
+            mem.owned.add(start >> cls.page_bits)
+        mem.size = len(cells)
+        return mem
+
+    def new_page(self):
+        return array('q', [0]) * self.page_size if self.typed else [0] * self.page_size
+
+    def make_page(self, values):
+        if self.typed:
+            try:
+                return array('q', values)
+            except OverflowError:
+                pass
+        return list(values)
+
+    def get(self, addr):
+        page = self.pages.get(addr >> self.page_bits)
+        if page is None:
+            if addr < 0:
+                raise Exception(f'Invalid address: {addr}')
+            return 0
+        return page[addr & self.page_mask]
+
+    def set(self, addr, val):
+        index = addr >> self.page_bits
+        page = self.pages.get(index)
+        if page is None:
+            if addr < 0:
+                raise Exception(f'Invalid address: {addr}')
+            page = self.new_page()
+            self.pages[index] = page
+            self.owned.add(index)
+            self.allocations += 1
+        elif index not in self.owned:
+            page = page[:]
+            self.pages[index] = page
+            self.owned.add(index)
+        try:
+            page[addr & self.page_mask] = val
+        except OverflowError:
+            page = page.tolist()
+            self.pages[index] = page
+            page[addr & self.page_mask] = val
+        if addr >= self.size:
+            self.size = addr + 1
+
+    __getitem__ = get
+    __setitem__ = set
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return (self.get(addr) for addr in range(self.size))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f'Memory({list(self)})'
+
+    def copy(self):
+        mem = Memory(typed=self.typed)
+        mem.pages = {i: page[:] for i, page in self.pages.items()}
+        mem.owned = set(mem.pages)
+        mem.size = self.size
+        return mem
+
+    # Returns a copy that shares all pages with this memory, copying each page
+    # only when either of them first writes to it
+    def fork(self):
+        mem = Memory(typed=self.typed)
+        mem.pages = self.pages.copy()
+        mem.size = self.size
+        self.owned = set()
+        return mem
+
+    def resident_pages(self):
+        return len(self.pages)
+
+# Input channel of a Program: a bounded FIFO queue held in a ring buffer, so
+# pushing and popping are O(1) and consumed slots are reused. The buffer
+# starts small and doubles as needed, up to the capacity, so programs that
+# are only given a few inputs don't pay for a full one. If the channel is
+# empty when the program reads from it, the producer, if there is one, is
+# asked for the value instead, so inputs never have to be computed before
+# the program needs them.
+class Channel:
+    default_capacity = 1024
+    initial_size = 8
+
+    def __init__(self, values=(), capacity=None, producer=None):
+        values = list(values)
+        # Always large enough for the initial values
+        self.capacity = max(capacity or self.default_capacity, len(values), 1)
+        size = min(max(len(values), self.initial_size), self.capacity)
+        self.buffer = values + [None] * (size - len(values))
+        self.head = 0
+        self.count = len(values)
+        # Called with no arguments, returning the next input or None if there
+        # isn't one yet
+        self.producer = producer
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        size = len(self.buffer)
+        return (self.buffer[(self.head + i) % size] for i in range(self.count))
+
+    def __repr__(self):
+        return f'Channel({list(self)})'
+
+    def append(self, val):
+        size = len(self.buffer)
+        if self.count == size:
+            if size == self.capacity:
+                raise Exception(f'Input channel is full: {self.capacity} values')
+            # Unwraps the queued values into a larger buffer
+            new_size = min(size * 2, self.capacity)
+            self.buffer = list(self) + [None] * (new_size - self.count)
+            self.head = 0
+            size = new_size
+        self.buffer[(self.head + self.count) % size] = val
+        self.count += 1
+
+    def extend(self, values):
+        for val in values:
+            self.append(val)
+
+    def popleft(self):
+        if self.count == 0:
+            raise Exception('Input channel is empty')
+        val = self.buffer[self.head]
+        self.buffer[self.head] = None
+        self.head = (self.head + 1) % len(self.buffer)
+        self.count -= 1
+        return val
+
+    # Returns the next input, from the producer if nothing is queued, or None
+    # if there isn't one
+    def get(self):
+        if self.count:
+            return self.popleft()
+        if self.producer is not None:
+            return self.producer()
+        return None
+
+    def clear(self):
+        while self.count:
+            self.popleft()
+
+    def copy(self):
+        return Channel(self, self.capacity, self.producer)
+
+# Execution profile of a Program, recorded when it is created with
+# profile=True: instruction counts per opcode and per pc, time spent in each
+# opcode, and how far memory grew.
+class Profile:
+    def __init__(self):
+        self.opcode_counts = Counter()
+        self.opcode_times = Counter()
+        self.pc_counts = Counter()
+        # Lengths of the instructions seen at each pc, to find hot ranges
+        self.pc_lengths = {}
+        self.resident_pages = 0
+        self.mem_size = 0
+        self.page_allocations = 0
+
+    def record_memory(self, mem):
+        # Lean programs may run on a plain list, which has no pages
+        if isinstance(mem, Memory):
+            self.resident_pages = max(self.resident_pages, mem.resident_pages())
+            self.page_allocations = mem.allocations
+        self.mem_size = max(self.mem_size, len(mem))
+
+    # Returns the ranges of code that ran the most instructions, as (start,
+    # end, instructions) with end exclusive, most first. A range is a run of
+    # consecutive instructions that were all executed the same number of
+    # times, so roughly a basic block.
+    def hot_ranges(self, limit=10):
+        ranges = []
+        prev_count = None
+        for pc in sorted(self.pc_counts):
+            count = self.pc_counts[pc]
+            if ranges and ranges[-1][1] == pc and prev_count == count:
+                (start, end, total) = ranges[-1]
+                ranges[-1] = (start, pc + self.pc_lengths[pc], total + count)
+            else:
+                ranges.append((pc, pc + self.pc_lengths[pc], count))
+            prev_count = count
+        return sorted(ranges, key=lambda r: r[2], reverse=True)[:limit]
+
+    def to_dict(self):
+        return {
+            'instructions': sum(self.opcode_counts.values()),
+            'opcodes': {name: {'count': self.opcode_counts[name], 'time': self.opcode_times[name]} for name in self.opcode_counts},
+            'pcs': {str(pc): count for pc, count in sorted(self.pc_counts.items())},
+            'hot_ranges': [{'start': start, 'end': end, 'count': count} for start, end, count in self.hot_ranges()],
+            'memory': {
+                'resident_pages': self.resident_pages,
+                'size': self.mem_size,
+                'page_allocations': self.page_allocations,
+            },
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_table(self):
+        total = sum(self.opcode_counts.values())
+        lines = [f'{"opcode":<24} {"count":>12} {"share":>7} {"time (s)":>10}']
+        for name, count in self.opcode_counts.most_common():
+            lines.append(f'{name:<24} {count:>12} {count / total:>7.1%} {self.opcode_times[name]:>10.4f}')
+        lines.append(f'{"total":<24} {total:>12}')
+        lines.append('')
+        lines.append(f'{"hot pc range":<24} {"count":>12} {"share":>7}')
+        for start, end, count in self.hot_ranges():
+            lines.append(f'{f"{start}-{end-1}":<24} {count:>12} {count / total:>7.1%}')
+        lines.append('')
+        lines.append(f'memory: {self.resident_pages} resident pages, size {self.mem_size}, {self.page_allocations} page allocations')
+        return '\n'.join(lines)
+
+class Program:
+    # Longest instruction (opcode plus three parameters), used to find the
+    # decoded instructions that cover a given memory cell.
+    max_instruction_length = 4
+
+    # Specialized handlers, keyed by the raw opcode value (opcode and modes).
+    # These don't depend on the program, so they are shared between instances.
+    handlers = {}
+
+    # Compiled basic blocks, keyed by their generated source. Like the
+    # handlers, these only depend on the code so are shared between instances.
+    # Only the most recently used max_compiled_blocks are kept, so a process
+    # running many programs doesn't keep every block it has compiled.
+    compiled_blocks = OrderedDict()
+    max_compiled_blocks = 4096
+
+    features = Feature.relative
+
+    # The feature level each opcode needs
+    opcode_features = {
+        1: Feature.basic,
+        2: Feature.basic,
+        3: Feature.io,
+        4: Feature.io,
+        5: Feature.io,
+        6: Feature.io,
+        7: Feature.io,
+        8: Feature.io,
+        9: Feature.relative,
+        99: Feature.basic,
+    }
+
+    def __init__(self, mem, input_=None, translate=False, profile=False):
+        self.mem = self.make_memory(mem)
+        self.pc = 0
+        # Inputs and outputs are queues, consumed as they are read, so the
+        # program doesn't keep a history of them
+        self.input = Channel(input_ or ())
+        self.output = deque()
+        # Set by instructions that should stop run_until
+        self.event = None
+        self.relative_base = 0
+        # Steps taken by run_until, not counting attempts to read an input
+        # that hadn't been given
+        self.steps = 0
+        # Handler for each pc that has been decoded, plus every memory cell
+        # those instructions were decoded from, so writes can invalidate them.
+        self.decode_cache = {}
+        self.decoded_cells = set()
+        # In translate mode, straight-line runs of instructions are compiled
+        # to Python functions. Maps the start pc of each block to its function
+        # (or False if nothing there can be translated), and each memory cell
+        # to the start pcs of the blocks that were translated from it.
+        self.translate = translate
+        self.block_cache = {}
+        self.block_cells = {}
+        # Cells that were written after being translated, e.g. addresses the
+        # program patches into its own instructions. Later translations read
+        # these at run time rather than baking them into the block.
+        self.volatile_cells = set()
+        # Profiling runs every instruction through the interpreter, even in
+        # translate mode, so counts are per instruction.
+        self.profile = Profile() if profile else None
+
+    @staticmethod
+    def make_memory(mem):
+        return mem if isinstance(mem, Memory) else Memory(mem)
+
+    # Returns a copy of the program in its current state, sharing memory
+    # pages with this one until either of them writes to them
+    def fork(self):
+        mem = self.mem.fork() if isinstance(self.mem, Memory) else self.mem.copy()
+        program = type(self)(mem, None, self.translate)
+        program.input = self.input.copy()
+        program.features = self.features
+        program.pc = self.pc
+        program.relative_base = self.relative_base
+        program.steps = self.steps
+        program.output = self.output.copy()
+        program.volatile_cells = self.volatile_cells.copy()
+        return program
+
+    # Runs until the program outputs a value, needs an input that hasn't been
+    # given, halts, or has taken max_steps steps, and returns which happened.
+    # In translate mode, a whole block counts as a single step.
+    #
+    # This is the interpreter's inner loop, so it keeps everything it needs
+    # in locals and allocates nothing per instruction. It is step() inlined.
+    def run_until(self, max_steps=None):
+        if self.pc is None:
+            return Event.halt
+        if self.profile is not None:
+            return self.run_until_profiled(max_steps)
+        self.event = None
+        decode_cache = self.decode_cache
+        decode_instruction = self.decode_instruction
+        block_cache = self.block_cache
+        translate = self.translate
+        pc = self.pc
+        steps = 0
+        try:
+            while self.event is None:
+                if steps == max_steps:
+                    return Event.budget
+                steps += 1
+                if translate:
+                    block = block_cache.get(pc)
+                    if block is None:
+                        block = self.translate_block(pc)
+                    if block:
+                        pc = block(self)
+                        continue
+                handler = decode_cache.get(pc)
+                if handler is None:
+                    handler = decode_instruction(pc)
+                pc = handler(self, pc)
+        finally:
+            self.pc = pc
+            # An input instruction that found no input stays to be retried,
+            # so doesn't count as a step
+            if self.event == Event.input:
+                steps -= 1
+            self.steps += steps
+        return self.event
+
+    # Same as run_until, but records every instruction in the profile
+    def run_until_profiled(self, max_steps):
+        self.event = None
+        profile = self.profile
+        pc = self.pc
+        steps = 0
+        try:
+            while self.event is None:
+                if steps == max_steps:
+                    return Event.budget
+                steps += 1
+                handler = self.decode_cache.get(pc)
+                if handler is None:
+                    handler = self.decode_instruction(pc)
+                profile.pc_counts[pc] += 1
+                profile.pc_lengths[pc] = handler.length
+                profile.opcode_counts[handler.name] += 1
+                start = time.perf_counter()
+                next_pc = handler(self, pc)
+                profile.opcode_times[handler.name] += time.perf_counter() - start
+                pc = next_pc
+        finally:
+            self.pc = pc
+            # An input instruction that found no input stays to be retried,
+            # so doesn't count as a step
+            if self.event == Event.input:
+                steps -= 1
+            self.steps += steps
+            profile.record_memory(self.mem)
+        return self.event
+
+    # Runs until the program halts or needs input, and returns which happened.
+    # Outputs are left queued in self.output.
+    def run(self):
+        while True:
+            event = self.run_until()
+            if event != Event.output:
+                return event
+
+    # Returns the next output, running the program if none is queued, or
+    # None if it halts or needs input first
+    def get_next_output(self):
+        if not self.output and self.run_until() != Event.output:
+            return None
+        return self.output.popleft()
+
+    # Whether the next instruction reads an input that hasn't been given yet
+    def needs_input(self):
+        if self.pc is None or self.get_mem(self.pc) % 100 != 3:
+            return False
+        return not self.input and self.input.producer is None
+
+    # Yields outputs as they are produced, until the program halts or needs
+    # input
+    def outputs(self):
+        while True:
+            output = self.get_next_output()
+            if output is None:
+                return
+            yield output
+
+    def get_mem(self, addr):
+        return self.mem.get(addr)
+
+    def set_mem(self, addr, val):
+        self.mem.set(addr, val)
+        if addr in self.decoded_cells:
+            self.invalidate(addr)
+
+    # Drop every decoded instruction and translated block that was read from
+    # the given cell
+    def invalidate(self, addr):
+        for pc in range(addr - self.max_instruction_length + 1, addr + 1):
+            handler = self.decode_cache.get(pc)
+            if handler is not None and pc + handler.length > addr:
+                del self.decode_cache[pc]
+        if addr in self.block_cells:
+            for start in self.block_cells.pop(addr):
+                self.block_cache.pop(start, None)
+            self.volatile_cells.add(addr)
+        self.decoded_cells.discard(addr)
+
+    @staticmethod
+    def parse_opcode(val):
+        val, opcode = divmod(val, 100)
+        modes = []
+        while val > 0:
+            val, mode = divmod(val, 10)
+            modes.append(mode)
+        return (opcode, modes)
+
+    def read_position(self, loc):
+        get = self.mem.get
+        return get(get(loc))
+
+    def read_immediate(self, loc):
+        return self.mem.get(loc)
+
+    def read_relative(self, loc):
+        get = self.mem.get
+        return get(get(loc) + self.relative_base)
+
+    def read_relative_output(self, loc):
+        return self.mem.get(loc) + self.relative_base
+
+    parameter_readers = {
+        ParameterMode.position: read_position,
+        ParameterMode.immediate: read_immediate,
+        ParameterMode.relative: read_relative,
+        ParameterMode.relative_output: read_relative_output,
+    }
+
+    @classmethod
+    def resolve_modes(cls, modes, num_params, output_params):
+        modes = modes[:num_params] + [ParameterMode.position] * (num_params - len(modes))
+        for i in output_params:
+            # Output paramters are not actually immediate mode, but we want
+            # to treat them as such: they return the output location, not
+            # the value at the output location.
+            if modes[i] == ParameterMode.position:
+                modes[i] = ParameterMode.immediate
+            elif modes[i] == ParameterMode.relative:
+                modes[i] = ParameterMode.relative_output
+        for mode in modes:
+            if mode not in cls.parameter_readers:
+                raise Exception(f'Invalid parameter mode: {mode}')
+        return modes
+
+    # Generic decorator to set up params, based on parameter modes. The
+    # decorated method takes the modes of one instruction and returns a
+    # handler specialized for them, which can then be run any number of times.
+    # Handlers take the program and pc, pass the pc and each parameter to the
+    # opcode method, and return the PC of the next instruction.
+    def opcode_template(num_params, output_params):
+        def decorator(func):
+            @functools.wraps(func)
+            def specialize(self, modes):
+                modes = self.resolve_modes(modes, num_params, output_params)
+                readers = [self.parameter_readers[mode] for mode in modes]
+
+                # One handler per arity, so no parameter list is built per call
+                if num_params == 0:
+                    def handler(program, pc):
+                        return func(program, pc)
+                elif num_params == 1:
+                    (read0,) = readers
+                    def handler(program, pc):
+                        return func(program, pc, read0(program, pc+1))
+                elif num_params == 2:
+                    (read0, read1) = readers
+                    def handler(program, pc):
+                        return func(program, pc, read0(program, pc+1), read1(program, pc+2))
+                else:
+                    (read0, read1, read2) = readers
+                    def handler(program, pc):
+                        return func(program, pc, read0(program, pc+1), read1(program, pc+2), read2(program, pc+3))
+                handler.length = num_params + 1
+                handler.name = func.__name__[len('opcode_'):]
+                return handler
+            specialize.num_params = num_params
+            specialize.output_params = output_params
+            return specialize
+        return decorator
+
+    @opcode_template(3, [2])
+    def opcode_add(self, pc, a, b, addr):
+        self.set_mem(addr, a + b)
+        return pc + 4
+
+    @opcode_template(3, [2])
+    def opcode_multiply(self, pc, a, b, addr):
+        self.set_mem(addr, a * b)
+        return pc + 4
+
+    @opcode_template(1, [0])
+    def opcode_input(self, pc, addr):
+        val = self.input.get()
+        if val is None:
+            # Stay on this instruction, to retry once input is given
+            self.event = Event.input
+            return pc
+        self.set_mem(addr, val)
+        return pc + 2
+
+    @opcode_template(1, [])
+    def opcode_output(self, pc, a):
+        self.output.append(a)
+        self.event = Event.output
+        return pc + 2
+
+    @opcode_template(2, [])
+    def opcode_jump_if_true(self, pc, a, target):
+        return target if a != 0 else pc + 3
+
+    @opcode_template(2, [])
+    def opcode_jump_if_false(self, pc, a, target):
+        return target if a == 0 else pc + 3
+
+    @opcode_template(3, [2])
+    def opcode_less_than(self, pc, a, b, addr):
+        self.set_mem(addr, int(a < b))
+        return pc + 4
+
+    @opcode_template(3, [2])
+    def opcode_equals(self, pc, a, b, addr):
+        self.set_mem(addr, int(a == b))
+        return pc + 4
+
+    @opcode_template(1, [])
+    def opcode_adjust_relative_base(self, pc, a):
+        self.relative_base += a
+        return pc + 2
+
+    @opcode_template(0, [])
+    def opcode_exit(self, pc):
+        self.event = Event.halt
+        return None
+
+    def get_opcodes(self):
+        return {
+            1: self.opcode_add,
+            2: self.opcode_multiply,
+            3: self.opcode_input,
+            4: self.opcode_output,
+            5: self.opcode_jump_if_true,
+            6: self.opcode_jump_if_false,
+            7: self.opcode_less_than,
+            8: self.opcode_equals,
+            9: self.opcode_adjust_relative_base,
+            99: self.opcode_exit,
+        }
+
+    # Returns the handler for the instruction at pc, decoding it if needed
+    def decode_instruction(self, pc):
+        opcodes = self.get_opcodes()
+        val = self.get_mem(pc)
+        if self.opcode_features.get(val % 100, self.features) > self.features:
+            raise Exception(f'Invalid opcode: {val % 100}')
+        handler = self.handlers.get(val)
+        if handler is None:
+            (opcode, modes) = self.parse_opcode(val)
+            if opcode not in opcodes:
+                raise Exception(f'Invalid opcode: {opcode}')
+            handler = opcodes[opcode](modes)
+            self.handlers[val] = handler
+
+        self.decode_cache[pc] = handler
+        self.decoded_cells.update(range(pc, pc + handler.length))
+        return handler
+
+    # Python source for each opcode that can appear in a translated block.
+    # Parameters are substituted as source for their values (or output
+    # locations); jumps also get the pc of the following instruction. Jumps
+    # read both parameters whether or not they are taken, as the interpreter
+    # does, so an invalid address raises either way.
+    block_templates = {
+        1: '{0} + {1}',
+        2: '{0} * {1}',
+        5: 'val, target = {0}, {1}; return target if val != 0 else {next}',
+        6: 'val, target = {0}, {1}; return target if val == 0 else {next}',
+        7: '1 if {0} < {1} else 0',
+        8: '1 if {0} == {1} else 0',
+        9: 'rb += {0}',
+    }
+
+    # Source for the value of the parameter stored at loc. This is normally
+    # the parameter itself, but volatile cells are read when the block runs.
+    def parameter_source(self, mode, loc):
+        val = f'get({loc})' if loc in self.volatile_cells else f'({self.get_mem(loc)})'
+        if mode == ParameterMode.position:
+            return f'get({val})'
+        elif mode == ParameterMode.immediate:
+            return val
+        elif mode == ParameterMode.relative:
+            return f'get(rb + {val})'
+        else:
+            return f'rb + {val}'
+
+    # Generates the source of the basic block starting at pc: every
+    # instruction up to and including the next jump, stopping before any
+    # input, output, exit or undecodable instruction. Returns the source (or
+    # None if the block is empty) and the cells it was translated from.
+    def block_source(self, start):
+        opcodes = self.get_opcodes()
+        lines = [
+            'def block(self):',
+            '    get = self.mem.__getitem__',
+            '    set_ = self.set_mem',
+            '    cells = self.decoded_cells',
+            '    rb = self.relative_base',
+        ]
+        cells = []
+        # The opcode, resolved modes and pc of each instruction
+        body = []
+        pc = start
+        while True:
+            (opcode, modes) = self.parse_opcode(self.get_mem(pc))
+            if opcode not in self.block_templates or self.opcode_features[opcode] > self.features:
+                break
+            specialize = opcodes[opcode]
+            try:
+                modes = self.resolve_modes(modes, specialize.num_params, specialize.output_params)
+            except Exception:
+                break
+            params = [self.parameter_source(mode, pc + i + 1) for i, mode in enumerate(modes)]
+            next_pc = pc + len(params) + 1
+            source = self.block_templates[opcode].format(*params, next=next_pc)
+            cells += [pc] + [addr for addr in range(pc + 1, next_pc) if addr not in self.volatile_cells]
+            body.append((opcode, modes, pc))
+
+            if opcode in [5, 6]:
+                if self.summarize_loops:
+                    lines += self.loop_summary_source(start, body, next_pc)
+                lines += ['    self.relative_base = rb', f'    {source}']
+                return ('\n'.join(lines), cells)
+            elif opcode == 9:
+                lines.append(f'    {source}')
+            else:
+                # Leave the block if it wrote to decoded code, since the rest
+                # of it may have been translated from stale values. This has
+                # to be checked before the write, which drops the cell from
+                # the decoded cells.
+                lines += [
+                    f'    addr = {params[2]}',
+                    '    code = addr in cells',
+                    f'    set_(addr, {source})',
+                    '    if code:',
+                    '        self.relative_base = rb',
+                    f'        return {next_pc}',
+                ]
+            pc = next_pc
+
+        if pc == start:
+            return (None, [start])
+        lines += ['    self.relative_base = rb', f'    return {pc}']
+        return ('\n'.join(lines), cells)
+
+    # Counting loops are run in a single step when translated, see
+    # loop_summary_source
+    summarize_loops = True
+
+    # Source for the cell a parameter reads or writes, or None if it doesn't
+    # refer to a cell that is fixed while the block runs
+    def parameter_cell(self, mode, loc):
+        if loc in self.volatile_cells:
+            return None
+        if mode in [ParameterMode.position, ParameterMode.immediate]:
+            # Output parameters were resolved to immediate mode
+            return f'({self.get_mem(loc)})'
+        else:
+            return f'rb + ({self.get_mem(loc)})'
+
+    # Source that runs a whole counting loop at once, to put at the start of
+    # the block for it, or no lines if the block isn't one. A counting loop is
+    # a block that jumps back to its own start while a counter is non-zero,
+    # and otherwise only adds a constant, or a cell the loop doesn't write, to
+    # cells, including the counter:
+    #
+    #   counter += step; acc += k; ...; jump_if_true counter, start
+    #
+    # If running it would bring the counter to exactly zero, after n
+    # iterations, each cell gets n times what it is added each iteration. The
+    # addresses are checked when the loop is entered, and if any of the cells
+    # written alias each other, a cell read or any decoded code, the block
+    # runs normally instead.
+    def loop_summary_source(self, start, body, exit_pc):
+        (opcode, modes, pc) = body[-1]
+        if opcode != 5 or modes[1] != ParameterMode.immediate or self.get_mem(pc + 2) != start or pc + 2 in self.volatile_cells:
+            return []
+        counter = self.parameter_cell(ParameterMode.immediate if modes[0] == ParameterMode.position else ParameterMode.relative_output, pc + 1)
+        if modes[0] == ParameterMode.immediate or counter is None:
+            return []
+
+        # Maps each cell written to the source of what is added to it, and
+        # the cells read to get those
+        adds = {}
+        reads = []
+        for (opcode, modes, pc) in body[:-1]:
+            if opcode != 1:
+                return []
+            out = self.parameter_cell(modes[2], pc + 3)
+            params = []
+            for i in [0, 1]:
+                if modes[i] == ParameterMode.immediate:
+                    # A constant read from a volatile cell can be rewritten
+                    # by the loop itself
+                    if pc + i + 1 in self.volatile_cells:
+                        return []
+                    params.append(('const', self.parameter_source(modes[i], pc + i + 1)))
+                else:
+                    mode = ParameterMode.immediate if modes[i] == ParameterMode.position else ParameterMode.relative_output
+                    params.append(('cell', self.parameter_cell(mode, pc + i + 1)))
+            if out is None or out in adds or None in [cell for _, cell in params]:
+                return []
+            # One parameter has to be the cell written
+            if params[0] == ('cell', out):
+                (kind, step) = params[1]
+            elif params[1] == ('cell', out):
+                (kind, step) = params[0]
+            else:
+                return []
+            if kind == 'cell':
+                reads.append(step)
+                step = f'get({step})'
+            adds[out] = step
+
+        # The counter has to step by a non-zero constant
+        if counter not in adds or adds[counter].startswith('get') or int(adds[counter].strip('()')) == 0:
+            return []
+        if any(cell in adds for cell in reads):
+            return []
+        step = int(adds[counter].strip('()'))
+
+        outs = ', '.join(adds)
+        lines = [
+            f'    c = get({counter})',
+            f'    if c % {-step} == 0 and c // {-step} > 0:',
+            f'        n = c // {-step}',
+            f'        outs = ({outs},)',
+            f'        reads = ({", ".join(reads)}{"," if reads else ""})',
+            '        if len(set(outs)) == len(outs) and cells.isdisjoint(outs) and set(outs).isdisjoint(reads):',
+        ]
+        # Work out every new value before writing any of them
+        for i, (out, step) in enumerate(adds.items()):
+            lines.append(f'            val{i} = get({out}) + n * {step}')
+        for i, out in enumerate(adds):
+            lines.append(f'            set_({out}, val{i})')
+        lines += [
+            '            self.relative_base = rb',
+            f'            return {exit_pc}',
+        ]
+        return lines
+
+    # Returns the function for the basic block at pc, translating it if
+    # needed, or False if the instruction at pc can't be translated
+    def translate_block(self, start):
+        (source, cells) = self.block_source(start)
+        if source is None:
+            block = False
+        else:
+            compiled_blocks = self.compiled_blocks
+            block = compiled_blocks.get(source)
+            if block is None:
+                namespace = {}
+                exec(compile(source, f'<intcode block at {start}>', 'exec'), namespace)
+                block = namespace['block']
+                compiled_blocks[source] = block
+                if len(compiled_blocks) > self.max_compiled_blocks:
+                    compiled_blocks.popitem(last=False)
+            else:
+                compiled_blocks.move_to_end(source)
+
+        self.block_cache[start] = block
+        for addr in cells:
+            self.block_cells.setdefault(addr, []).append(start)
+        self.decoded_cells.update(cells)
+        return block
+
+
+# Program for code that doesn't need relative mode or memory growth. Memory is
+# used as given, normally a plain list, so parameters are read by indexing it
+# directly instead of going through Memory's pages, and writes past the end
+# raise IndexError. Opcodes beyond the program's feature level are invalid.
+class LeanProgram(Program):
+    # Handlers are specialized with this class's parameter readers, so can't
+    # be shared with Program
+    handlers = {}
+
+    features = Feature.io
+
+    def __init__(self, mem, input_=None, translate=False, profile=False, features=Feature.io):
+        super().__init__(mem, input_, translate, profile)
+        if features > Feature.io:
+            raise Exception(f'LeanProgram does not support {features.name}')
+        self.features = features
+
+    @staticmethod
+    def make_memory(mem):
+        return mem
+
+    def get_mem(self, addr):
+        return self.mem[addr]
+
+    def set_mem(self, addr, val):
+        self.mem[addr] = val
+        if addr in self.decoded_cells:
+            self.invalidate(addr)
+
+    def read_position(self, loc):
+        mem = self.mem
+        return mem[mem[loc]]
+
+    def read_immediate(self, loc):
+        return self.mem[loc]
+
+    parameter_readers = {
+        ParameterMode.position: read_position,
+        ParameterMode.immediate: read_immediate,
+    }
+
+# Returns a program that supports the given features, using LeanProgram for
+# those it covers
+def create_program(mem, input_=None, features=Feature.relative, translate=False, profile=False):
+    if features >= Feature.relative:
+        return Program(mem, input_, translate, profile)
+    return LeanProgram(mem, input_, translate, profile, features)
+
+class Test(unittest.TestCase):
+    # Runs the program with every configuration of Program, and of
+    # LeanProgram if it doesn't need relative mode
+    def run_test(self, mem, output_mem, input_='', output='', features=Feature.io):
+        programs = [Program(Memory(mem, typed), input_, translate) for translate, typed in itertools.product([False, True], repeat=2)]
+        if features < Feature.relative:
+            programs += [create_program(list(mem), input_, features, translate) for translate in [False, True]]
+        for program in programs:
+            program.run()
+            if output_mem is not None:
+                self.assertEqual(program.mem, output_mem)
+            if output:
+                self.assertEqual(list(program.output), output)
+
+    def test_run_program(self):
+        self.run_test([1,0,0,0,99], [2,0,0,0,99])
+        self.run_test([2,3,0,3,99], [2,3,0,6,99])
+        self.run_test([2,4,4,5,99,0], [2,4,4,5,99,9801])
+        self.run_test([1,1,1,4,99,5,6,0,99], [30,1,1,4,2,5,6,0,99])
+        self.run_test([1101,100,-1,4,0], [1101,100,-1,4,99])
+        self.run_test([1001,5,-1,4,0,100], [1001,5,-1,4,99,100])
+        self.run_test([3,9,8,9,10,9,4,9,99,-1,8], None, [8], [1])
+        self.run_test([3,9,8,9,10,9,4,9,99,-1,8], None, [1], [0])
+        self.run_test([3,9,8,9,10,9,4,9,99,-1,8], None, [9], [0])
+        self.run_test([3,9,7,9,10,9,4,9,99,-1,8], None, [-1], [1])
+        self.run_test([3,9,7,9,10,9,4,9,99,-1,8], None, [8], [0])
+        self.run_test([3,9,7,9,10,9,4,9,99,-1,8], None, [9], [0])
+        self.run_test([3,3,1108,-1,8,3,4,3,99], None, [8], [1])
+        self.run_test([3,3,1108,-1,8,3,4,3,99], None, [1], [0])
+        self.run_test([3,3,1108,-1,8,3,4,3,99], None, [9], [0])
+        self.run_test([3,3,1107,-1,8,3,4,3,99], None, [-1], [1])
+        self.run_test([3,3,1107,-1,8,3,4,3,99], None, [8], [0])
+        self.run_test([3,3,1107,-1,8,3,4,3,99], None, [9], [0])
+        self.run_test([3,12,6,12,15,1,13,14,13,4,13,99,-1,0,1,9], None, [0], [0])
+        self.run_test([3,12,6,12,15,1,13,14,13,4,13,99,-1,0,1,9], None, [5], [1])
+        self.run_test([3,3,1105,-1,9,1101,0,0,12,4,12,99,1], None, [0], [0])
+        self.run_test([3,3,1105,-1,9,1101,0,0,12,4,12,99,1], None, [5], [1])
+        self.run_test([3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99], None, [3], [999])
+        self.run_test([3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99], None, [8], [1000])
+        self.run_test([3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99], None, [10], [1001])
+
+        quine = [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
+        self.run_test([109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99], None, [], quine, Feature.relative)
+
+        self.run_test([1102,34915192,34915192,7,4,7,99,0], None, [], [1219070632396864])
+        self.run_test([104,1125899906842624,99], None, [], [1125899906842624])
+        self.run_test([1102,4294967296,4294967296,7,4,7,99,0], None, [], [18446744073709551616])
+
+        # Overwrites an instruction that has already been run
+        self.run_test([104,7,1101,0,99,0,1105,1,0], [99,7,1101,0,99,0,1105,1,0], [], [7])
+
+    def test_run_until(self):
+        program = Program([3,9,8,9,10,9,4,9,99,-1,8])
+        self.assertEqual(program.run_until(), Event.input)
+        # Blocking on input isn't a step, however often it is retried
+        self.assertEqual(program.steps, 0)
+        self.assertEqual(program.run_until(), Event.input)
+        self.assertEqual(program.steps, 0)
+        program.input.append(8)
+        self.assertEqual(program.run_until(max_steps=1), Event.budget)
+        self.assertEqual(program.steps, 1)
+        self.assertEqual(program.run_until(), Event.output)
+        self.assertEqual(list(program.outputs()), [1])
+        self.assertEqual(program.run_until(), Event.halt)
+        self.assertEqual(len(program.output), 0)
+
+    def test_profile(self):
+        program = Program([1101,0,3,20,1001,20,-1,20,1005,20,4,104,7,99], profile=True)
+        program.run()
+        profile = program.profile
+        self.assertEqual(profile.opcode_counts['add'], 4)
+        self.assertEqual(profile.opcode_counts['jump_if_true'], 3)
+        self.assertEqual(profile.pc_counts[4], 3)
+        self.assertEqual(profile.hot_ranges()[0], (4, 11, 6))
+        self.assertEqual(profile.resident_pages, 1)
+        self.assertEqual(json.loads(profile.to_json())['instructions'], 9)
+        self.assertIn('jump_if_true', profile.to_table())
+
+    def test_sparse_memory(self):
+        program = Program([1101,1,1,1000000000000,4,1000000000000,99])
+        program.run()
+        self.assertEqual(list(program.output), [2])
+        self.assertEqual(program.mem.resident_pages(), 2)
+        self.assertEqual(len(program.mem), 1000000000001)
+
+    def test_typed_memory(self):
+        mem = Memory([1, 2, 3], typed=True)
+        self.assertIsInstance(mem.pages[0], array)
+        mem[300] = 2**63
+        self.assertIsInstance(mem.pages[0], array)
+        self.assertIsInstance(mem.pages[1], list)
+        self.assertEqual(mem[300], 2**63)
+        self.assertEqual(Memory([2**100, 1], typed=True), [2**100, 1])
+
+        copy = mem.copy()
+        copy[0] = 4
+        self.assertEqual(mem[0], 1)
+
+    def test_fork(self):
+        mem = Memory(list(range(1000)))
+        fork = mem.fork()
+        fork[0] = -1
+        mem[300] = -2
+        self.assertEqual(fork[300], 300)
+        self.assertEqual(mem[0], 0)
+        self.assertIs(fork.pages[2], mem.pages[2])
+        self.assertIsNot(fork.pages[0], mem.pages[0])
+
+        # Snapshot a program before it reads its input, and run both copies
+        program = Program([104,0,3,11,8,11,12,11,4,11,99,-1,8])
+        self.assertEqual(program.get_next_output(), 0)
+        snapshot = program.fork()
+        program.input.append(8)
+        snapshot.input.append(1)
+        self.assertEqual(program.get_next_output(), 1)
+        self.assertEqual(snapshot.get_next_output(), 0)
+
+    def test_translate_matches_interpreter(self):
+        # Returns how a program ends: its outputs and memory, or the error it
+        # raised. None if it is still running after the budget.
+        def outcome(mem, translate):
+            program = Program(list(mem), [1,-2,3,0,5] * 4, translate=translate)
+            try:
+                event = Event.output
+                while event == Event.output:
+                    event = program.run_until(5000 - program.steps)
+            except Exception as e:
+                return ('error', str(e), list(program.output))
+            if event == Event.budget:
+                return None
+            return (event, list(program.output), list(program.mem))
+
+        # A jump not taken, whose target is an invalid address
+        mem = [1108,-3,-1,2,21101,-5,2,0,22208,33,13,41,204,41,2208,41,15,21,2108,0,2,3,20001,5,48,39,2206,32,45,101,5,6,44,108,-3,21,25,2006,36,6,99,3,-3,1,3,-3,-1,1,-1,-3,3,2,3,-2,1,1]
+        self.assertEqual(outcome(mem, False), ('error', 'Invalid address: -6', [0]))
+        self.assertEqual(outcome(mem, True), outcome(mem, False))
+
+        # Random programs, most of which fail
+        num_params = {1: 3, 2: 3, 3: 1, 4: 1, 5: 2, 6: 2, 7: 3, 8: 3, 9: 1, 99: 0}
+        rng = random.Random(0)
+        for _ in range(500):
+            mem = []
+            while len(mem) < 40:
+                opcode = rng.choice(list(num_params))
+                modes = [rng.choice([0, 1, 2]) for _ in range(num_params[opcode])]
+                mem.append(opcode + sum(mode * 10**(i+2) for i, mode in enumerate(modes)))
+                mem += [rng.randint(-3, 50) for _ in modes]
+            mem += [rng.randint(-3, 3) for _ in range(20)]
+            expected = outcome(mem, False)
+            if expected is not None:
+                self.assertEqual(outcome(mem, True), expected, mem)
+
+    def test_loop_summary(self):
+        # Returns the outputs of the program and how many steps it took in
+        # translate mode
+        def run(mem, summarize=True):
+            program = Program(mem + [0] * (40 - len(mem)), translate=True)
+            program.summarize_loops = summarize
+            steps = 0
+            while program.run_until(max_steps=1) != Event.halt:
+                steps += 1
+            return (list(program.output), steps)
+
+        # Countdown, multiplication by repeated addition, relative mode, and
+        # a counter counting up. The loop is entered once, so takes one step.
+        self.assertEqual(run([1101,0,100000,30, 1001,30,-1,30, 1005,30,4, 4,30, 99]), ([0], 3))
+        self.assertEqual(run([1101,0,100000,30, 1001,30,-1,30, 1005,30,4, 4,30, 99], False), ([0], 100001))
+        self.assertEqual(run([1101,0,7,30, 1101,0,6,32, 1001,30,-1,30, 1,31,32,31, 1005,30,8, 4,31, 99]), ([42], 3))
+        self.assertEqual(run([109,30, 21101,0,7,0, 21101,0,6,2, 21201,0,-1,0, 22201,1,2,1, 1205,0,10, 204,1, 99]), ([42], 3))
+        self.assertEqual(run([1101,0,-6,30, 1001,30,2,30, 1001,31,5,31, 1005,30,4, 4,31, 99]), ([15], 3))
+
+        # Loops that run normally: one adds a cell it also writes, through a
+        # different mode, and one writes to its own code
+        for mem in [
+            [1101,0,4,30, 1001,30,-1,30, 2001,31,30,31, 1005,30,4, 4,31, 99],
+            [1101,0,3,30, 1001,30,-1,30, 1001,6,0,6, 1005,30,4, 4,30, 99],
+        ]:
+            self.assertEqual(run(mem), run(mem, False))
+        self.assertEqual(run([1101,0,4,30, 1001,30,-1,30, 2001,31,30,31, 1005,30,4, 4,31, 99]), ([6], 5))
+
+        # A step read from a cell the loop itself increments
+        mem = [1101,0,5,40, 1001,40,-1,40, 1001,41,1,41, 1001,10,1,10, 1005,40,4, 4,41, 99]
+        self.assertEqual(run(mem)[0], [15])
+        self.assertEqual(run(mem, False)[0], [15])
+
+    def test_compiled_blocks_limit(self):
+        saved = (Program.compiled_blocks, Program.max_compiled_blocks)
+        (Program.compiled_blocks, Program.max_compiled_blocks) = (OrderedDict(), 2)
+        try:
+            for i in range(5):
+                program = Program([1101,i,1,7, 4,7, 99, 0], translate=True)
+                program.run()
+                self.assertEqual(list(program.output), [i + 1])
+            self.assertEqual(len(Program.compiled_blocks), 2)
+        finally:
+            (Program.compiled_blocks, Program.max_compiled_blocks) = saved
+
+    def test_lean_program(self):
+        mem = [1101,0,3,20,1001,20,-1,20,1005,20,4,104,7,99] + [0] * 7
+        program = create_program(mem, features=Feature.io)
+        self.assertIsInstance(program, LeanProgram)
+        self.assertEqual(list(program.outputs()), [7])
+        # Memory is the list given, and isn't copied
+        self.assertIs(program.mem, mem)
+
+        fork = create_program([3,5,4,5,99,0], features=Feature.io).fork()
+        fork.input.append(4)
+        self.assertEqual(fork.get_next_output(), 4)
+
+        with self.assertRaises(Exception):
+            create_program([109,1,99], features=Feature.io).run()
+        with self.assertRaises(Exception):
+            create_program([204,1,99], features=Feature.io).run()
+        with self.assertRaises(Exception):
+            create_program([3,0,99], [1], Feature.basic).run()
+        with self.assertRaises(IndexError):
+            create_program([1101,1,1,100,99], features=Feature.io).run()
+        self.assertIsInstance(create_program([99]), Program)
+        self.assertNotIsInstance(create_program([99]), LeanProgram)
+
+    def test_channel(self):
+        channel = Channel([1, 2], capacity=3)
+        channel.append(3)
+        with self.assertRaises(Exception):
+            channel.append(4)
+        self.assertEqual(channel.popleft(), 1)
+        # Reuses the slot that was read
+        channel.append(4)
+        self.assertEqual(list(channel), [2, 3, 4])
+        self.assertEqual(channel.buffer, [4, 2, 3])
+        channel.clear()
+        self.assertEqual(len(channel), 0)
+        self.assertIsNone(channel.get())
+        self.assertEqual(Channel(range(2000)).capacity, 2000)
+
+        # The buffer grows up to the capacity, keeping the queued values in
+        # order when they wrap around
+        channel = Channel(capacity=18)
+        channel.extend(range(6))
+        self.assertEqual([channel.popleft() for _ in range(4)], [0, 1, 2, 3])
+        channel.extend(range(6, 20))
+        self.assertEqual(len(channel.buffer), 16)
+        channel.extend(range(20, 22))
+        self.assertEqual(len(channel.buffer), 18)
+        with self.assertRaises(Exception):
+            channel.append(22)
+        self.assertEqual(list(channel), list(range(4, 22)))
+
+        # The producer is only asked once the queued inputs are used up
+        asked = []
+        def producer():
+            asked.append(len(asked))
+            return len(asked) if len(asked) < 3 else None
+        program = Program([3,9,4,9,1105,1,0,99,99,0], [7])
+        program.input.producer = producer
+        self.assertEqual(program.run(), Event.input)
+        self.assertEqual(list(program.output), [7, 1, 2])
+        self.assertEqual(asked, [0, 1, 2])
+
+    def test_needs_input(self):
+        program = create_program([3,5,4,5,99,0], features=Feature.io)
+        self.assertTrue(program.needs_input())
+        program.input.append(1)
+        self.assertFalse(program.needs_input())
+        program.run()
+        self.assertFalse(program.needs_input())
+
+if __name__ == '__main__':
+    unittest.main()
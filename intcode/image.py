@@ -0,0 +1,213 @@
+# Compiled program images, so a program's source only has to be parsed once.
+#
+# An image is a header with a checksum of the source, followed by the cells
+# packed as values:
+#
+#   header    magic, version, checksum of the source
+#   counts    cell count, overflow count
+#   cells     cell count * little-endian int64
+#   overflow  per entry: cell index (uint64), length (uint32), signed big-endian bytes
+#
+# Cells whose values don't fit in 64 bits are stored as 0 in the packed cells,
+# with their real value in the overflow side-table.
+#
+# Images are cached next to their source, as <source>.img. Loading maps the
+# file and exposes the packed cells as a memoryview, which Memory copies a page
+# at a time without converting each value. A cache whose checksum doesn't match
+# the source is stale and is rebuilt.
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import unittest
+from array import array
+
+from .engine import Memory, Program
+
+MAGIC = b'ICIM'
+VERSION = 2
+HEADER = struct.Struct('<4sHH16s')
+COUNTS = struct.Struct('<QQ')
+CELL = struct.Struct('<q')
+OVERFLOW_ENTRY = struct.Struct('<QI')
+
+def checksum(source):
+    return hashlib.blake2b(source, digest_size=16).digest()
+
+def image_path(source_path):
+    return source_path + '.img'
+
+# Returns the packed form of a list of values
+def pack_values(values):
+    overflow = []
+    try:
+        cells = array('q', values).tobytes()
+    except OverflowError:
+        cells = bytearray(len(values) * CELL.size)
+        for i, val in enumerate(values):
+            try:
+                CELL.pack_into(cells, i * CELL.size, val)
+            except struct.error:
+                overflow.append((i, val))
+
+    parts = [COUNTS.pack(len(values), len(overflow)), cells]
+    for i, val in overflow:
+        data = val.to_bytes((val.bit_length() + 8) // 8, 'big', signed=True)
+        parts += [OVERFLOW_ENTRY.pack(i, len(data)), data]
+    return b''.join(parts)
+
+# Reads packed values starting at offset in buffer. Returns the cells as an
+# int64 memoryview of the buffer, the overflow side-table as a dict, and the
+# offset of whatever follows.
+def unpack_values(buffer, offset):
+    (num_cells, num_overflow) = COUNTS.unpack_from(buffer, offset)
+    start = offset + COUNTS.size
+    end = start + num_cells * CELL.size
+    if len(buffer) < end:
+        raise Exception('Packed values are truncated')
+    cells = memoryview(buffer)[start:end].cast('q')
+
+    overflow = {}
+    offset = end
+    for _ in range(num_overflow):
+        (i, length) = OVERFLOW_ENTRY.unpack_from(buffer, offset)
+        offset += OVERFLOW_ENTRY.size
+        overflow[i] = int.from_bytes(buffer[offset:offset+length], 'big', signed=True)
+        offset += length
+    return (cells, overflow, offset)
+
+# Returns the values of packed values as a list
+def values_to_list(cells, overflow):
+    values = cells.tolist()
+    for i, val in overflow.items():
+        values[i] = val
+    return values
+
+# Returns the image bytes for the given source text
+def compile_image(source):
+    values = list(map(int, source.split(b',')))
+    return HEADER.pack(MAGIC, VERSION, 0, checksum(source)) + pack_values(values)
+
+# Writes to a temporary file and renames it, so a concurrent reader never
+# sees a partly written file
+def write_file(path, data):
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+class Image:
+    def __init__(self, buffer, source):
+        self.buffer = buffer
+        (magic, version, _, digest) = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise Exception('Not an Intcode image')
+        if digest != checksum(source):
+            raise Exception('Image is stale')
+        (self.cells, self.overflow, _) = unpack_values(buffer, HEADER.size)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def to_list(self):
+        return values_to_list(self.cells, self.overflow)
+
+    def memory(self, typed=False):
+        mem = Memory.from_buffer(self.cells, typed)
+        for i, val in self.overflow.items():
+            mem[i] = val
+        return mem
+
+    def close(self):
+        self.cells.release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+def map_image(path, source):
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return Image(buffer, source)
+    except Exception:
+        buffer.close()
+        raise
+
+# Returns the image of the program at source_path, from the cache if it is
+# up to date, otherwise compiling it and writing it to the cache. If the
+# cache can't be written the image is kept in memory.
+def load_image(source_path='input.txt'):
+    with open(source_path, 'rb') as f:
+        source = f.read().strip()
+    path = image_path(source_path)
+    try:
+        return map_image(path, source)
+    except Exception:
+        pass
+
+    data = compile_image(source)
+    try:
+        write_file(path, data)
+    except OSError:
+        return Image(data, source)
+    return map_image(path, source)
+
+# Like engine.read_input, but parsing the source only when the cached image
+# is missing or stale
+def read_input(path='input.txt'):
+    image = load_image(path)
+    try:
+        return image.to_list()
+    finally:
+        image.close()
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.source_path = os.path.join(self.dir.name, 'input.txt')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write_source(self, values):
+        with open(self.source_path, 'w') as f:
+            f.write(','.join(map(str, values)) + '\n')
+
+    def test_load_image(self):
+        values = [1, -2, 2**63 - 1, -2**63, 2**70, -2**100, 99] + list(range(600))
+        self.write_source(values)
+        image = load_image(self.source_path)
+        self.assertTrue(os.path.exists(image_path(self.source_path)))
+        self.assertEqual(image.to_list(), values)
+        self.assertEqual(image.overflow, {4: 2**70, 5: -2**100})
+        self.assertEqual(image.memory(), values)
+        self.assertEqual(image.memory(typed=True), values)
+        image.close()
+
+        # Loaded from the cache the second time
+        mtime = os.stat(image_path(self.source_path)).st_mtime_ns
+        self.assertEqual(read_input(self.source_path), values)
+        self.assertEqual(os.stat(image_path(self.source_path)).st_mtime_ns, mtime)
+
+    def test_stale_image(self):
+        self.write_source([104, 1, 99])
+        self.assertEqual(read_input(self.source_path), [104, 1, 99])
+        self.write_source([104, 2, 99])
+        self.assertEqual(read_input(self.source_path), [104, 2, 99])
+
+        with open(image_path(self.source_path), 'wb') as f:
+            f.write(b'garbage')
+        self.assertEqual(read_input(self.source_path), [104, 2, 99])
+
+    def test_run_image(self):
+        self.write_source([1102, 34915192, 34915192, 7, 4, 7, 99, 0])
+        image = load_image(self.source_path)
+        program = Program(image.memory(typed=True))
+        program.run()
+        self.assertEqual(list(program.output), [1219070632396864])
+        image.close()
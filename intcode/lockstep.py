@@ -0,0 +1,246 @@
+# Runs many instances ("lanes") of the same program in lockstep, with NumPy.
+#
+# The memory of every lane is held in one (lanes, mem_size) int64 array. Each
+# step groups the lanes by pc (and by opcode, in case a lane rewrote its
+# code) and runs each group's instruction for all of its lanes at once, so
+# sweeps over many inputs run as a few array operations per instruction.
+#
+# Only the day 5 instruction set is supported: parameters are in position or
+# immediate mode, and there is no relative base. Memory can't grow past
+# mem_size, and values can't grow past int64: a lane that uses an address
+# outside its memory, or whose arithmetic overflows, stops with an error in
+# errors instead of carrying on with a wrapped around value, and the other
+# lanes run on.
+
+import unittest
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .engine import ParameterMode, Program
+
+class BatchProgram:
+    # Runs num_lanes copies of mem, or with no num_lanes, one lane per row of
+    # mem, a 2D array that is run in place
+    def __init__(self, mem, num_lanes=None, mem_size=None):
+        if num_lanes is None:
+            self.mem = mem
+        else:
+            mem_size = max(mem_size or 0, len(mem))
+            self.mem = np.zeros((num_lanes, mem_size), dtype=np.int64)
+            self.mem[:, :len(mem)] = list(mem)
+        num_lanes = len(self.mem)
+        self.pc = np.zeros(num_lanes, dtype=np.int64)
+        self.halted = np.zeros(num_lanes, dtype=bool)
+        # Lanes waiting on an input that hasn't been sent yet
+        self.blocked = np.zeros(num_lanes, dtype=bool)
+        self.input = [[] for _ in range(num_lanes)]
+        self.input_offset = np.zeros(num_lanes, dtype=np.int64)
+        self.output = [[] for _ in range(num_lanes)]
+        # The error each lane stopped on, or None
+        self.errored = np.zeros(num_lanes, dtype=bool)
+        self.errors = [None] * num_lanes
+
+    # Appends one input to each lane
+    def send(self, values):
+        for lane, val in enumerate(values):
+            self.input[lane].append(int(val))
+        self.blocked[:] = False
+
+    # Returns a mask of the lanes that can run
+    def runnable(self):
+        return ~self.halted & ~self.blocked & ~self.errored
+
+    def run(self):
+        while self.step(self.runnable()):
+            pass
+
+    # Runs every lane until it outputs a value, halts, stops on an error or
+    # needs an input that hasn't been sent. Returns the new output of each lane (0 for lanes that
+    # didn't output anything) and a mask of the lanes that produced one.
+    def get_next_output(self):
+        initial_output_len = np.array([len(output) for output in self.output])
+        while True:
+            output_len = np.array([len(output) for output in self.output])
+            if not self.step(self.runnable() & (output_len == initial_output_len)):
+                break
+        produced = output_len > initial_output_len
+        values = np.array([output[-1] if new else 0 for output, new in zip(self.output, produced)], dtype=np.int64)
+        return (values, produced)
+
+    # Runs one instruction on each of the given lanes. Returns whether any
+    # lane was run.
+    def step(self, mask):
+        lanes = np.flatnonzero(mask)
+        if len(lanes) == 0:
+            return False
+        pcs = self.pc[lanes]
+        valid = self.check_addresses(lanes, pcs)
+        (lanes, pcs) = (lanes[valid], pcs[valid])
+        for pc in np.unique(pcs):
+            group = lanes[pcs == pc]
+            vals = self.mem[group, pc]
+            for val in np.unique(vals):
+                self.run_instruction(group[vals == val], int(pc), int(val))
+        return True
+
+    def set_error(self, lanes, message):
+        for lane in lanes:
+            self.errored[lane] = True
+            self.errors[lane] = message
+
+    # Stops the lanes whose address is outside memory with an error, and
+    # returns a mask of the others
+    def check_addresses(self, lanes, addrs):
+        invalid = (addrs < 0) | (addrs >= self.mem.shape[1])
+        for lane, addr in zip(lanes[invalid], addrs[invalid]):
+            if addr < 0:
+                self.set_error([lane], f'Invalid address: {addr}')
+            else:
+                self.set_error([lane], f'Address past the end of memory: {addr}')
+        return ~invalid
+
+    # Returns the lanes whose parameters could all be read, and the
+    # parameter values of each of them
+    def get_parameter_values(self, lanes, pc, modes, num_params, output_params):
+        for mode in modes:
+            if mode not in [ParameterMode.position, ParameterMode.immediate]:
+                raise Exception(f'Invalid parameter mode: {mode}')
+        modes = modes + [ParameterMode.position] * (num_params - len(modes))
+        params = []
+        for i in range(num_params):
+            if pc+i+1 >= self.mem.shape[1]:
+                self.set_error(lanes, f'Address past the end of memory: {pc+i+1}')
+                return (lanes[:0], [np.zeros(0, dtype=np.int64)] * num_params)
+            param = self.mem[lanes, pc+i+1]
+            if modes[i] == ParameterMode.position:
+                valid = self.check_addresses(lanes, param)
+                (lanes, params, param) = (lanes[valid], [param[valid] for param in params], param[valid])
+                # Output parameters are the output location, as in Program
+                if i not in output_params:
+                    param = self.mem[lanes, param]
+            params.append(param)
+        return (lanes, params)
+
+    # Returns a mask of the lanes where a + b or a * b, computed as a wrapped
+    # around int64 result, overflowed
+    @staticmethod
+    def overflowed(opcode, a, b, result):
+        if opcode == 1:
+            # The sign of the result is wrong if both operands' signs differ
+            # from it
+            return ((a ^ result) & (b ^ result)) < 0
+        # Dividing back gives b only if nothing was lost. -1 is left out of
+        # the division, which would itself overflow.
+        min_value = np.iinfo(np.int64).min
+        divisor = np.where((a == 0) | (a == -1), 1, a)
+        return np.where(a == -1, b == min_value, (a != 0) & (result // divisor != b))
+
+    def run_instruction(self, lanes, pc, val):
+        (opcode, modes) = Program.parse_opcode(val)
+        if opcode in [1, 2, 7, 8]:
+            (lanes, (a, b, addr)) = self.get_parameter_values(lanes, pc, modes, 3, [2])
+            if opcode in [1, 2]:
+                result = a + b if opcode == 1 else a * b
+                overflow = self.overflowed(opcode, a, b, result)
+                self.set_error(lanes[overflow], 'Integer overflow')
+                (lanes, addr, result) = (lanes[~overflow], addr[~overflow], result[~overflow])
+                self.mem[lanes, addr] = result
+            elif opcode == 7:
+                self.mem[lanes, addr] = a < b
+            else:
+                self.mem[lanes, addr] = a == b
+            self.pc[lanes] = pc + 4
+        elif opcode == 3:
+            (lanes, (addr,)) = self.get_parameter_values(lanes, pc, modes, 1, [0])
+            for lane, lane_addr in zip(lanes, addr):
+                if self.input_offset[lane] == len(self.input[lane]):
+                    self.blocked[lane] = True
+                    continue
+                try:
+                    self.mem[lane, lane_addr] = self.input[lane][self.input_offset[lane]]
+                except OverflowError:
+                    self.set_error([lane], 'Integer overflow')
+                    continue
+                self.input_offset[lane] += 1
+                self.pc[lane] = pc + 2
+        elif opcode == 4:
+            (lanes, (a,)) = self.get_parameter_values(lanes, pc, modes, 1, [])
+            for lane, val in zip(lanes, a):
+                self.output[lane].append(int(val))
+            self.pc[lanes] = pc + 2
+        elif opcode in [5, 6]:
+            (lanes, (a, target)) = self.get_parameter_values(lanes, pc, modes, 2, [])
+            jump = (a != 0) if opcode == 5 else (a == 0)
+            self.pc[lanes] = np.where(jump, target, pc + 3)
+        elif opcode == 99:
+            self.halted[lanes] = True
+        else:
+            raise Exception(f'Invalid opcode: {opcode}')
+
+@unittest.skipIf(np is None, 'requires numpy')
+class Test(unittest.TestCase):
+    def test_lanes(self):
+        mems = np.array([[1,0,0,0,99], [2,3,0,3,99], [2,4,4,0,99]])
+        BatchProgram(mems).run()
+        self.assertEqual(mems.tolist(), [[2,0,0,0,99], [2,3,0,6,99], [9801,4,4,0,99]])
+
+    def test_io(self):
+        # Outputs 1 if its input is 8, else 0
+        program = BatchProgram([3,9,8,9,10,9,4,9,99,-1,8], 3)
+        program.send([7, 8, 9])
+        (values, produced) = program.get_next_output()
+        self.assertEqual(values.tolist(), [0, 1, 0])
+        self.assertTrue(produced.all())
+        program.run()
+        self.assertTrue(program.halted.all())
+
+        # Waiting for input
+        program = BatchProgram([3,0,99], 2)
+        self.assertFalse(program.get_next_output()[1].any())
+        self.assertTrue(program.blocked.all())
+
+    def test_invalid(self):
+        with self.assertRaisesRegex(Exception, 'Invalid parameter mode: 2'):
+            BatchProgram([204,0,99], 2).run()
+        with self.assertRaisesRegex(Exception, 'Invalid opcode: 12'):
+            BatchProgram([12,0,99], 2).run()
+
+    def test_errors(self):
+        big = 2**62
+        min_value = -2**63
+        # Each lane reads, writes or jumps outside memory, or overflows,
+        # except the last, which runs on to output its sum
+        mems = np.array([
+            [1,-1,0,0,4,0,99,0],
+            [1,0,0,8,4,0,99,0],
+            [1105,1,-3,0,4,0,99,0],
+            [1106,0,6,0,4,0,1,0],
+            [1101,big,big,0,4,0,99,0],
+            [1102,big,2,0,4,0,99,0],
+            [1102,-1,min_value,0,4,0,99,0],
+            [1101,big,-big,0,4,0,99,0],
+        ])
+        program = BatchProgram(mems)
+        program.run()
+        self.assertEqual(program.errors, [
+            'Invalid address: -1',
+            'Address past the end of memory: 8',
+            'Invalid address: -3',
+            'Address past the end of memory: 8',
+            'Integer overflow',
+            'Integer overflow',
+            'Integer overflow',
+            None,
+        ])
+        self.assertEqual(program.output, [[]] * 7 + [[0]])
+        self.assertEqual(program.halted.tolist(), [False] * 7 + [True])
+        # Nothing was written by the lanes that overflowed
+        self.assertEqual(mems[4:7, 0].tolist(), [1101, 1102, 1102])
+
+        # Products that only just fit don't overflow
+        program = BatchProgram([1102,-big,2,0,4,0,99], 1)
+        self.assertEqual(program.get_next_output()[0].tolist(), [min_value])
+        self.assertFalse(program.errored.any())
@@ -0,0 +1,250 @@
+# On-disk cache of the results of deterministic runs, so running the same
+# program with the same input again costs a file read.
+#
+# Entries are keyed by a hash of the program image, the input sequence and
+# the feature level it was run with, and hold the output sequence, the event
+# the run stopped on and a digest of the final memory. Whole computations
+# built on programs, such as a feedback loop of amplifiers, can be cached the
+# same way with RunCache.call, under a name of their own.
+#
+# Each entry is a file in the cache directory. Reading an entry updates its
+# modification time, and once the entries take up more than max_bytes the
+# least recently used ones are deleted. The cache is opt-in: days use it when
+# the INTCODE_CACHE environment variable names a directory.
+
+import hashlib
+import os
+import struct
+import tempfile
+import time
+import unittest
+from collections import namedtuple
+
+from .engine import Event, Feature, Memory, Program, create_program
+from .image import pack_values, unpack_values, values_to_list, write_file
+
+RunResult = namedtuple('RunResult', ['output', 'event', 'mem_digest'])
+
+# Part of every key, bumped when what an entry holds changes so that older
+# entries are no longer found
+VERSION = 2
+
+ENTRY = struct.Struct('<B16s')
+
+# Returns a digest of the cells of a memory, or a list. The same values give
+# the same digest whichever form they are stored in: memory is hashed as the
+# blocks of Memory.page_size cells that aren't all zeros, so neither how it
+# is paged nor any zeros past the last value written change the digest.
+def memory_digest(mem):
+    if isinstance(mem, Memory):
+        blocks = ((index, mem.pages[index]) for index in sorted(mem.pages))
+    else:
+        mem = list(mem)
+        blocks = ((start // Memory.page_size, mem[start:start+Memory.page_size])
+                  for start in range(0, len(mem), Memory.page_size))
+    digest = hashlib.blake2b(digest_size=16)
+    for index, block in blocks:
+        if any(block):
+            block = list(block)
+            block.extend([0] * (Memory.page_size - len(block)))
+            digest.update(pack_values([index] + block))
+    return digest.digest()
+
+class RunCache:
+    default_max_bytes = 64 << 20
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes if max_bytes is not None else self.default_max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Size of the entries, kept up to date as they are stored so the
+        # directory is only scanned when it may need evicting
+        self.size = sum(size for _, size, _ in self.entries())
+
+    # Returns the cache in the directory named by INTCODE_CACHE, or None if
+    # it isn't set
+    @classmethod
+    def from_env(cls):
+        directory = os.environ.get('INTCODE_CACHE')
+        return cls(directory) if directory else None
+
+    def key(self, name, mem, input_, features=None):
+        digest = hashlib.blake2b(bytes([VERSION]) + name.encode() + b'\0', digest_size=20)
+        if features is not None:
+            digest.update(bytes([features]))
+        digest.update(pack_values(list(mem)))
+        digest.update(pack_values(list(input_)))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.run')
+
+    # Returns the entry for key, or None if there isn't one
+    def lookup(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            (event, mem_digest) = ENTRY.unpack_from(data)
+            (cells, overflow, _) = unpack_values(data, ENTRY.size)
+        except Exception:
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return RunResult(values_to_list(cells, overflow), Event(event), mem_digest)
+
+    def store(self, key, result):
+        data = ENTRY.pack(result.event, result.mem_digest) + pack_values(list(result.output))
+        path = self.path(key)
+        # An entry stored again replaces the old one
+        try:
+            self.size -= os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        write_file(path, data)
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    # Returns the (modification time, size, path) of each entry
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.run'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    # Deletes the least recently used entries until the cache fits in
+    # max_bytes
+    def evict(self):
+        entries = self.entries()
+        self.size = sum(size for _, size, _ in entries)
+        for (_, size, path) in sorted(entries):
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            self.evictions += 1
+
+    # Runs a program until it halts or needs more input, returning its
+    # outputs, the event it stopped on and a digest of its final memory
+    def run(self, mem, input_=(), features=Feature.relative):
+        key = self.key('run', mem, input_, features)
+        result = self.lookup(key)
+        if result is None:
+            program = create_program(list(mem), list(input_), features)
+            event = program.run()
+            result = RunResult(list(program.output), event, memory_digest(program.mem))
+            self.store(key, result)
+        return result
+
+    # Returns the values cached under the given name for mem and input_, or
+    # None if there aren't any
+    def get(self, name, mem, input_):
+        result = self.lookup(self.key(name, mem, input_))
+        return None if result is None else result.output
+
+    def put(self, name, mem, input_, values):
+        self.store(self.key(name, mem, input_), RunResult(list(values), Event.halt, bytes(16)))
+
+    # Returns func(), a list of values computed from mem and input_ alone,
+    # from the cache under the given name if it is there
+    def call(self, name, mem, input_, func):
+        values = self.get(name, mem, input_)
+        if values is None:
+            values = list(func())
+            self.put(name, mem, input_, values)
+        return values
+
+    def report(self):
+        entries = self.entries()
+        size = sum(size for _, size, _ in entries)
+        return f'run cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, {len(entries)} entries ({size} bytes)'
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_run(self):
+        cache = RunCache(self.dir.name)
+        mem = [3,9,8,9,10,9,4,9,99,-1,8]
+        result = cache.run(mem, [8])
+        self.assertEqual(result.output, [1])
+        self.assertEqual(result.event, Event.halt)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        # A new cache on the same directory finds it
+        cache = RunCache(self.dir.name)
+        self.assertEqual(cache.run(mem, [8]), result)
+        self.assertEqual(cache.run(mem, [7]).output, [0])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertIn('1 hits, 1 misses', cache.report())
+
+        # Stopping for input, and values beyond 64 bits
+        result = cache.run([104,2**70,3,0,99])
+        self.assertEqual(result, RunResult([2**70], Event.input, result.mem_digest))
+        self.assertEqual(cache.run([104,2**70,3,0,99]), result)
+
+        program = Program([104,2**70,3,0,99])
+        program.run()
+        self.assertEqual(memory_digest(program.mem), result.mem_digest)
+
+        # The digest doesn't depend on how the memory is stored
+        values = [104,2**70,3,0,99] + [0] * 300 + [7]
+        digest = memory_digest(values)
+        self.assertEqual(memory_digest(Memory(values)), digest)
+        self.assertEqual(memory_digest(Memory(values[:5] + [0] * 300 + [7], typed=True)), digest)
+        self.assertEqual(memory_digest(values + [0] * 1000), digest)
+        self.assertNotEqual(memory_digest(values[:-1]), digest)
+        sparse = Memory()
+        sparse[1000] = 5
+        self.assertEqual(memory_digest(sparse), memory_digest([0] * 1000 + [5]))
+
+        # Each feature level gets its own entry, though the final memory is
+        # the same whether it is held in pages or a list
+        result = cache.run(mem, [8], Feature.io)
+        self.assertEqual(result.output, [1])
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(result.mem_digest, cache.run(mem, [8]).mem_digest)
+
+    def test_call(self):
+        cache = RunCache(self.dir.name)
+        calls = []
+        def func():
+            calls.append(1)
+            return [42]
+        self.assertEqual(cache.call('answer', [99], [1], func), [42])
+        self.assertEqual(cache.call('answer', [99], [1], func), [42])
+        self.assertEqual(len(calls), 1)
+        # Different names don't share entries
+        cache.call('other', [99], [1], func)
+        self.assertEqual(len(calls), 2)
+
+        # Storing an entry again doesn't count its old size
+        size = cache.size
+        cache.put('answer', [99], [1], [42])
+        self.assertEqual(cache.size, size)
+        self.assertEqual(cache.size, sum(size for _, size, _ in cache.entries()))
+
+    def test_evict(self):
+        cache = RunCache(self.dir.name, max_bytes=200)
+        for i in range(10):
+            cache.run([104,i,99])
+            # Keep the first entry the most recently used
+            cache.run([104,0,99])
+            time.sleep(0.01)
+        self.assertGreater(cache.evictions, 0)
+        names = os.listdir(self.dir.name)
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.dir.name, name)) for name in names), 200)
+        self.assertIn(os.path.basename(cache.path(cache.key('run', [104,0,99], [], Feature.relative))), names)
@@ -0,0 +1,451 @@
+# A local server that runs Intcode jobs on a pool of worker processes, so
+# runs don't each pay for starting Python and loading the engine.
+#
+#   python -m intcode.server --socket /tmp/intcode.sock --workers 4
+#   python -m intcode.server --port 8765
+#
+# Clients connect over a Unix socket, or TCP on localhost, and talk in JSON
+# lines. A job names its program by its cells or by the path of its source,
+# and can give input, a step budget, a feature level and translate mode:
+#
+#   {"id": 1, "program": [104, 1, 99], "input": [], "steps": 1000}
+#   {"id": 2, "path": "09/input.txt", "input": [1], "translate": true}
+#
+# Outputs are streamed back in chunks as the program produces them, followed
+# by the event the job stopped on and the steps it took, or an error:
+#
+#   {"id": 1, "output": [1]}
+#   {"id": 1, "done": true, "event": "halt", "steps": 2}
+#   {"id": 3, "error": "Invalid opcode: 12"}
+#
+# {"stats": true} returns the queue depth and throughput of the server.
+#
+# Each worker starts its programs from their warm start, so it only runs each
+# image's prologue once. A job's budget and cancellation apply to the
+# prologue too. Sources are parsed without the image cache, so the server
+# never writes next to a file a client names.
+#
+# A job is cancelled when its client disconnects, so a program that never
+# halts doesn't keep its worker busy forever. Workers check for that every
+# cancel_check_steps steps.
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import select
+import signal
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+
+from .engine import Event, Feature, read_input
+from .warm import start_from, warm_snapshot
+
+# Outputs a worker collects before sending them, unless flush_interval
+# seconds have passed since it last sent any
+chunk_size = 256
+flush_interval = 0.05
+
+cancel_check_steps = 100000
+
+# Seconds between checks that a job's client is still connected
+poll_interval = 0.1
+
+# Runs a job, passing each message about it to send. Raises if cancelled()
+# becomes true before the job is done.
+def run_job(request, send, cancelled=lambda: False):
+    if 'program' in request:
+        mem = request['program']
+    elif 'path' in request:
+        mem = read_input(request['path'])
+    else:
+        raise Exception('Job has no program or path')
+    features = Feature(request.get('features', Feature.relative))
+    translate = request.get('translate', False)
+    max_steps = request.get('steps')
+    snapshot = warm_snapshot(mem, features, translate, max_steps, cancelled)
+    program = start_from(snapshot, mem, request.get('input'), max_steps)
+
+    last_flush = time.monotonic()
+    while True:
+        if cancelled():
+            raise Exception('Job was cancelled')
+        budget = cancel_check_steps if max_steps is None else min(max(max_steps - program.steps, 0), cancel_check_steps)
+        event = program.run_until(budget)
+        if event == Event.budget and (max_steps is None or program.steps < max_steps):
+            continue
+        if event != Event.output:
+            break
+        if len(program.output) >= chunk_size or time.monotonic() - last_flush >= flush_interval:
+            send({'output': list(program.output)})
+            program.output.clear()
+            last_flush = time.monotonic()
+    if program.output:
+        send({'output': list(program.output)})
+    send({'done': True, 'event': event.name, 'steps': program.steps})
+
+# Takes jobs until it is given None. Every message is tagged with the job's
+# id, and a job's first message says it has started on this worker. The job
+# stops once cancel holds its id.
+def worker(index, jobs, results, cancel):
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        (job_id, request) = job
+        results.put((job_id, {'started': True, 'worker': index}))
+        try:
+            run_job(request, lambda message: results.put((job_id, message)), lambda: cancel.value == job_id)
+        except Exception as e:
+            results.put((job_id, {'error': str(e)}))
+
+class Stats:
+    def __init__(self, workers):
+        self.workers = workers
+        self.start = time.monotonic()
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.outputs = 0
+        self.steps = 0
+
+    def to_dict(self):
+        elapsed = time.monotonic() - self.start
+        finished = self.completed + self.failed
+        return {
+            'workers': self.workers,
+            'queued': self.submitted - self.started,
+            'running': self.started - finished,
+            'completed': self.completed,
+            'failed': self.failed,
+            'outputs': self.outputs,
+            'steps': self.steps,
+            'uptime': elapsed,
+            'jobs_per_second': finished / elapsed,
+            'steps_per_second': self.steps / elapsed,
+        }
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        pool = self.server.pool
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.send({'error': 'Invalid JSON'})
+                continue
+            if request.get('stats'):
+                self.send(pool.get_stats())
+                continue
+            messages = pool.run(request, self.connected)
+            try:
+                for message in messages:
+                    self.send(message)
+            finally:
+                # Cancels the job if sending failed
+                messages.close()
+
+    # Whether the client is still connected, without reading any of its
+    # requests
+    def connected(self):
+        (readable, _, _) = select.select([self.connection], [], [], 0)
+        if not readable:
+            return True
+        try:
+            return bool(self.connection.recv(1, socket.MSG_PEEK))
+        except OSError:
+            return False
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b'\n')
+        self.wfile.flush()
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# The worker processes and the jobs running on them. A dispatcher thread
+# passes each result to the queue of the job it belongs to.
+class Pool:
+    def __init__(self, workers=None):
+        workers = workers or os.cpu_count() or 1
+        self.jobs = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        # The id of the job each worker should cancel
+        self.cancels = [multiprocessing.Value('q', -1) for _ in range(workers)]
+        self.processes = [multiprocessing.Process(target=worker, args=(i, self.jobs, self.results, self.cancels[i]), daemon=True)
+                          for i in range(workers)]
+        for process in self.processes:
+            process.start()
+        self.stats = Stats(workers)
+        self.lock = threading.Lock()
+        self.waiting = {}
+        # The worker each started job is running on
+        self.running = {}
+        self.next_id = 0
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def dispatch(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            (job_id, message) = result
+            with self.lock:
+                if 'started' in message:
+                    self.stats.started += 1
+                    if job_id in self.waiting:
+                        self.running[job_id] = message['worker']
+                    else:
+                        # The job's client went before it started
+                        self.cancels[message['worker']].value = job_id
+                    continue
+                if 'output' in message:
+                    self.stats.outputs += len(message['output'])
+                else:
+                    self.running.pop(job_id, None)
+                    if 'error' in message:
+                        self.stats.failed += 1
+                    elif 'done' in message:
+                        self.stats.completed += 1
+                        self.stats.steps += message['steps']
+                # The job's client may have gone
+                messages = self.waiting.get(job_id)
+            if messages is not None:
+                messages.put(message)
+
+    # Submits a job and yields the messages about it as they arrive, ending
+    # with its done or error message. Each is tagged with the request's id.
+    # The job is cancelled if the generator is closed before then, or
+    # connected, if given, returns false while waiting for a message.
+    def run(self, request, connected=None):
+        messages = queue.Queue()
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            self.waiting[job_id] = messages
+            self.stats.submitted += 1
+        self.jobs.put((job_id, request))
+        try:
+            while True:
+                try:
+                    message = messages.get(timeout=poll_interval)
+                except queue.Empty:
+                    if connected is not None and not connected():
+                        return
+                    continue
+                message['id'] = request.get('id')
+                yield message
+                if 'done' in message or 'error' in message:
+                    return
+        finally:
+            with self.lock:
+                del self.waiting[job_id]
+                # Still running, as the job's done or error message removes it
+                worker_index = self.running.pop(job_id, None)
+                if worker_index is not None:
+                    self.cancels[worker_index].value = job_id
+
+    def get_stats(self):
+        with self.lock:
+            return self.stats.to_dict()
+
+    def close(self):
+        for _ in self.processes:
+            self.jobs.put(None)
+        for process in self.processes:
+            process.join()
+        self.results.put(None)
+        self.dispatcher.join()
+
+# Serves jobs at address, a Unix socket path or a (host, port) pair, in a
+# background thread until closed
+class Server:
+    def __init__(self, address, workers=None):
+        self.address = address
+        # The workers are started before any threads, so forking them is safe
+        self.pool = Pool(workers)
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            self.server = UnixServer(address, Handler)
+        else:
+            self.server = TCPServer(address, Handler)
+            self.address = self.server.server_address
+        self.server.pool = self.pool
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.pool.close()
+        if isinstance(self.address, str):
+            os.unlink(self.address)
+
+class Client:
+    def __init__(self, address):
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.connect(address)
+        self.file = self.socket.makefile('rwb')
+
+    def request(self, message):
+        self.file.write(json.dumps(message).encode() + b'\n')
+        self.file.flush()
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            raise Exception('Server closed the connection')
+        return json.loads(line)
+
+    # Runs a job, yielding its outputs as they arrive. The done message is
+    # kept in self.result.
+    def stream(self, program=None, input_=(), steps=None, path=None, features=Feature.relative, translate=False):
+        request = {'input': list(input_), 'steps': steps, 'features': features, 'translate': translate}
+        if path is not None:
+            request['path'] = os.path.abspath(path)
+        else:
+            request['program'] = list(program)
+        self.request(request)
+        while True:
+            message = self.receive()
+            if 'error' in message:
+                raise Exception(message['error'])
+            if 'done' in message:
+                self.result = message
+                return
+            yield from message['output']
+
+    # Runs a job, returning its outputs, the event it stopped on and the
+    # steps it took
+    def run(self, *args, **kwargs):
+        output = list(self.stream(*args, **kwargs))
+        return (output, Event[self.result['event']], self.result['steps'])
+
+    def stats(self):
+        self.request({'stats': True})
+        return self.receive()
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+class Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.server = Server(os.path.join(cls.dir.name, 'intcode.sock'), workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        cls.dir.cleanup()
+
+    def setUp(self):
+        self.client = Client(self.server.address)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_run(self):
+        quine = [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
+        self.assertEqual(self.client.run(quine), (quine, Event.halt, 81))
+        self.assertEqual(self.client.run([3,9,8,9,10,9,4,9,99,-1,8], [8], translate=True)[0], [1])
+
+        # Waiting for input, and running out of steps
+        self.assertEqual(self.client.run([3,0,99]), ([], Event.input, 0))
+        self.assertEqual(self.client.run([1105,1,0], steps=100), ([], Event.budget, 100))
+
+        # A program given by the path of its source
+        path = os.path.join(self.dir.name, 'input.txt')
+        with open(path, 'w') as f:
+            f.write('104,1125899906842624,99\n')
+        self.assertEqual(self.client.run(path=path)[0], [1125899906842624])
+        # Without writing an image next to it
+        self.assertFalse(os.path.exists(path + '.img'))
+
+    def test_stream(self):
+        # Counts up forever, so the outputs have to be streamed
+        counter = [1001,9,1,9,4,9,1105,1,0,0]
+        outputs = []
+        for output in self.client.stream(counter, steps=3000):
+            outputs.append(output)
+        self.assertEqual(outputs, list(range(1, 1001)))
+        self.assertEqual(self.client.result['event'], 'budget')
+
+    def test_errors(self):
+        with self.assertRaises(Exception):
+            self.client.run([12,0,99])
+        # The connection is still usable
+        self.assertEqual(self.client.run([104,1,99])[0], [1])
+        self.client.request({'input': []})
+        self.assertIn('error', self.client.receive())
+
+    def test_cancel(self):
+        failed = self.client.stats()['failed']
+        # Loops forever without output, so only stops when cancelled
+        for _ in range(3):
+            client = Client(self.server.address)
+            client.request({'program': [1105,1,0]})
+            client.close()
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            stats = self.client.stats()
+            if stats['failed'] == failed + 3 and stats['queued'] == 0 and stats['running'] == 0:
+                break
+            time.sleep(0.05)
+        self.assertEqual((stats['failed'] - failed, stats['queued'], stats['running']), (3, 0, 0))
+        # The workers are free for new jobs
+        self.assertEqual(self.client.run([104,1,99])[0], [1])
+
+    def test_concurrent_clients(self):
+        clients = [Client(self.server.address) for _ in range(4)]
+        results = [None] * len(clients)
+        def run(i):
+            results[i] = clients[i].run([3,11,1002,11,3,11,4,11,99,0,0,0], [i])[0]
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(clients))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for client in clients:
+            client.close()
+        self.assertEqual(results, [[0], [3], [6], [9]])
+
+        stats = self.client.stats()
+        self.assertEqual(stats['workers'], 2)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['running'], 0)
+        self.assertGreaterEqual(stats['completed'], 4)
+        self.assertGreater(stats['steps_per_second'], 0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs Intcode jobs on a pool of worker processes')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--socket', help='Unix socket path to listen on')
+    group.add_argument('--port', type=int, help='TCP port to listen on, on localhost')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    server = Server(args.socket or ('127.0.0.1', args.port), args.workers)
+    print(f'Serving on {server.address} with {len(server.pool.processes)} workers')
+    # Shut down cleanly when terminated, as when interrupted
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.close()
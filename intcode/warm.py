@@ -0,0 +1,225 @@
+# Warm starts, so the instructions a program runs before it first reads an
+# input are only run once per program image.
+#
+# Until a program reads its first input, everything it does is fixed by its
+# image, so a fresh instance always reaches the same state there. WarmStarts
+# runs that prologue once, keeps the program stopped at its first input (or
+# wherever it halted, or once it runs too long) as a snapshot, and starts
+# new instances as copy-on-write forks of it. Outputs from the prologue are
+# left queued in the new instance, and its steps counted, as if it had run
+# the prologue itself.
+#
+# Snapshots are kept in memory, keyed by a hash of the image and the program
+# configuration, up to max_snapshots of the most recently used. Given a
+# directory, they are also saved there as checkpoints, so other processes
+# start from them too.
+
+import hashlib
+import os
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from .checkpoint import dump_program, load_program
+from .engine import Channel, Event, Feature, LeanProgram, Program, create_program
+from .image import pack_values, write_file
+
+class WarmStarts:
+    # Most steps run before taking a snapshot, so a program that never reads
+    # input doesn't run forever
+    prologue_steps = 1000000
+    slice_steps = 100000
+    max_snapshots = 64
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.snapshots = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the warm starts saved in the directory named by INTCODE_CACHE,
+    # or kept in memory only if it isn't set
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ.get('INTCODE_CACHE') or None)
+
+    def key(self, mem, features, translate):
+        digest = hashlib.blake2b(bytes([features, translate]), digest_size=20)
+        digest.update(pack_values(list(mem)))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.warm')
+
+    # Returns the program for mem stopped before its first input, running the
+    # prologue if it isn't cached. With max_steps, a prologue that isn't
+    # cached is only run that far, and if it doesn't finish, the program is
+    # returned where it stopped without being cached. cancelled, if given, is
+    # checked every slice_steps steps, and the prologue raises once it is true.
+    def snapshot(self, mem, features=Feature.relative, translate=False, max_steps=None, cancelled=None):
+        key = self.key(mem, features, translate)
+        snapshot = self.snapshots.get(key)
+        if snapshot is None and self.directory is not None:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    (snapshot, metadata) = load_program(f.read())
+                snapshot.steps = metadata['steps']
+            except Exception:
+                pass
+        if snapshot is None:
+            self.misses += 1
+            snapshot = create_program(mem.copy(), None, features, translate)
+            limit = self.prologue_steps if max_steps is None else min(self.prologue_steps, max_steps)
+            while True:
+                if cancelled is not None and cancelled():
+                    raise Exception('Prologue was cancelled')
+                event = snapshot.run_until(min(limit - snapshot.steps, self.slice_steps))
+                if event != Event.output and not (event == Event.budget and snapshot.steps < limit):
+                    break
+            if event == Event.budget and snapshot.steps < self.prologue_steps:
+                # Stopped by max_steps, so not the whole prologue
+                return snapshot
+            if self.directory is not None:
+                write_file(self.path(key), dump_program(snapshot, {'steps': snapshot.steps}))
+        else:
+            self.hits += 1
+        self.snapshots[key] = snapshot
+        self.snapshots.move_to_end(key)
+        if len(self.snapshots) > self.max_snapshots:
+            self.snapshots.popitem(last=False)
+        return snapshot
+
+    # Returns a new program for mem with the given input, started from the
+    # snapshot of its prologue
+    def start(self, mem, input_=None, features=Feature.relative, translate=False):
+        return start_from(self.snapshot(mem, features, translate), mem, input_)
+
+    def report(self):
+        return f'warm starts: {self.hits} hits, {self.misses} misses, {len(self.snapshots)} snapshots'
+
+# Returns a program for mem with the given input, forked from its snapshot,
+# or started from the beginning if the prologue alone took more than
+# max_steps
+def start_from(snapshot, mem, input_=None, max_steps=None):
+    if max_steps is not None and snapshot.steps > max_steps:
+        return create_program(list(mem), input_, snapshot.features, snapshot.translate)
+    program = snapshot.fork()
+    # Sized to fit the input, as Program sizes its channel
+    channel = snapshot.input
+    program.input = Channel(list(channel) + list(input_ or ()), channel.capacity, channel.producer)
+    return program
+
+default_warm_starts = None
+
+# Returns the WarmStarts shared by warm_snapshot and warm_start, made by
+# WarmStarts.from_env the first time it is needed
+def get_warm_starts():
+    global default_warm_starts
+    if default_warm_starts is None:
+        default_warm_starts = WarmStarts.from_env()
+    return default_warm_starts
+
+def warm_snapshot(mem, features=Feature.relative, translate=False, max_steps=None, cancelled=None):
+    return get_warm_starts().snapshot(mem, features, translate, max_steps, cancelled)
+
+# Like create_program, but starting from the shared warm start of mem
+def warm_start(mem, input_=None, features=Feature.relative, translate=False):
+    return get_warm_starts().start(mem, input_, features, translate)
+
+class Test(unittest.TestCase):
+    # Outputs its first two cells, then outputs its input doubled
+    mem = [4,0,4,1,1101,2,3,17,3,18,102,2,18,18,4,18,99,0,0]
+
+    def test_start(self):
+        warm = WarmStarts()
+        first = warm.start(self.mem, [5])
+        second = warm.start(self.mem, [6])
+        self.assertEqual((warm.hits, warm.misses), (1, 1))
+        self.assertEqual(first.pc, 8)
+        self.assertEqual(list(first.outputs()), [4, 0, 10])
+        self.assertEqual(list(second.outputs()), [4, 0, 12])
+        # The snapshot is untouched by the programs started from it
+        self.assertEqual(list(warm.start(self.mem, [7]).outputs()), [4, 0, 14])
+
+        # Each configuration gets its own snapshot
+        program = warm.start(self.mem, [1], Feature.io, translate=True)
+        self.assertIsInstance(program, LeanProgram)
+        self.assertTrue(program.translate)
+        self.assertEqual(list(program.outputs()), [4, 0, 2])
+        self.assertEqual(warm.misses, 2)
+
+        # Programs that halt or never read input
+        self.assertEqual(warm.start([104,1,99]).pc, None)
+        self.assertEqual(list(warm.start([104,1,99]).outputs()), [1])
+        warm.prologue_steps = 10
+        program = warm.start([104,1,1105,1,0])
+        self.assertEqual(program.steps, 10)
+        self.assertEqual(len(program.output), 5)
+
+        # Too many steps for a budget
+        snapshot = warm.snapshot([104,1,1105,1,0])
+        self.assertEqual(start_from(snapshot, [104,1,1105,1,0], max_steps=20).steps, 10)
+        self.assertEqual(start_from(snapshot, [104,1,1105,1,0], max_steps=5).steps, 0)
+
+    def test_max_snapshots(self):
+        warm = WarmStarts()
+        warm.max_snapshots = 2
+        for i in range(3):
+            warm.snapshot([104,i,3,0,99])
+        warm.snapshot([104,1,3,0,99])
+        self.assertEqual(len(warm.snapshots), 2)
+        # The least recently used was dropped
+        warm.snapshot([104,0,3,0,99])
+        self.assertEqual((warm.hits, warm.misses), (1, 4))
+
+    def test_budget_and_cancel(self):
+        warm = WarmStarts()
+        loop = [104,1,1105,1,0]
+        # Stopped by the budget, so not cached
+        program = warm.snapshot(loop, max_steps=10)
+        self.assertEqual(program.steps, 10)
+        self.assertEqual(start_from(program, loop, max_steps=10).run_until(0), Event.budget)
+        self.assertEqual(len(warm.snapshots), 0)
+        # A prologue that finishes within the budget is cached
+        self.assertEqual(warm.snapshot(self.mem, max_steps=10).steps, 3)
+        self.assertEqual(len(warm.snapshots), 1)
+
+        warm.slice_steps = 5
+        checks = []
+        def cancelled():
+            checks.append(1)
+            return len(checks) > 2
+        with self.assertRaisesRegex(Exception, 'cancelled'):
+            warm.snapshot(loop, cancelled=cancelled)
+
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as dir_:
+            WarmStarts(dir_).snapshot(self.mem)
+            warm = WarmStarts(dir_)
+            program = warm.start(self.mem, [5])
+            self.assertEqual((warm.hits, warm.misses), (1, 0))
+            self.assertEqual(program.steps, 3)
+            self.assertEqual(list(program.outputs()), [4, 0, 10])
+
+            # A corrupt snapshot is run again
+            for name in os.listdir(dir_):
+                with open(os.path.join(dir_, name), 'wb') as f:
+                    f.write(b'garbage')
+            warm = WarmStarts(dir_)
+            self.assertEqual(list(warm.start(self.mem, [5]).outputs()), [4, 0, 10])
+            self.assertEqual(warm.misses, 1)
+
+    def test_long_input(self):
+        # More input than fits in a default channel
+        program = WarmStarts().start([3,0,99], list(range(2000)))
+        self.assertEqual(len(program.input), 2000)
+        self.assertEqual(program.run_until(), Event.halt)
+        self.assertEqual(program.mem[0], 0)
+
+    def test_matches_cold_start(self):
+        quine = [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
+        program = Program(quine.copy())
+        program.run()
+        self.assertEqual(list(WarmStarts().start(quine).outputs()), list(program.output))